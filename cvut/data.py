@@ -1,79 +1,367 @@
 # ------------------------------------------------------------------------------
 #  Libraries
 # ------------------------------------------------------------------------------
+import zlib
 import base64
+import struct
+import warnings
 import numpy as np
 import pycocotools.mask as mask_util
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
-__all__ = ['FIFOQueue',
+__all__ = ['FIFOQueue', 'RingBuffer',
            'encode_base64', 'decode_base64',
-           'encode_rle', 'decode_rle']
+           'encode_frame', 'decode_frame',
+           'encode_frame_base64', 'decode_frame_base64',
+           'encode_rle', 'decode_rle', 'decode_rle_crop']
 
 
 # ------------------------------------------------------------------------------
 #  FIFOQueue
 # ------------------------------------------------------------------------------
 class FIFOQueue(object):
-    """First-In-First-Out Queue"""
+    """
+    First-In-First-Out Queue over a ring buffer. A table of item counts, and
+    of items per count, makes push, pop, check_in_queue, check_unique_item
+    and most_common O(1). Items must be hashable.
+    """
 
     def __init__(self, queue_len):
-        self.queue = queue_len * [None]
         self.queue_len = queue_len
+        self.reset()
 
     def update_queue_len(self, queue_len):
         self.queue_len = queue_len
 
     def push(self, item):
         overflow_item = None
-        while True:
-            if len(self.queue) >= self.queue_len:
-                overflow_item = self.pop()
-            else:
-                break
+        while self.size >= self.queue_len:
+            overflow_item = self.pop()
 
-        self.queue.append(item)
+        if self.size == len(self.buffer):
+            self._resize(max(self.queue_len, self.size + 1))
+        self.buffer[(self.head + self.size) % len(self.buffer)] = item
+        self.size += 1
+        self._count(item, 1)
         return overflow_item
 
     def pop(self):
-        item = self.queue.pop(0)
+        if not self.size:
+            raise IndexError("pop from empty FIFOQueue")
+        item = self.buffer[self.head]
+        self.buffer[self.head] = None
+        self.head = (self.head + 1) % len(self.buffer)
+        self.size -= 1
+        self._count(item, -1)
         return item
 
     def check_in_queue(self, item):
-        return item in self.queue
+        return item in self.counts
 
     def check_unique_item(self):
-        uniq_item = self.queue[0]
-        for item in self.queue[1:]:
-            if item != uniq_item:
-                return False, uniq_item
-        return True, uniq_item
+        if not self.size:
+            raise IndexError("FIFOQueue is empty")
+        uniq_item = self.buffer[self.head]
+        return self.counts[uniq_item] == self.size, uniq_item
+
+    def most_common(self):
+        """Return (item, count) of the majority item, None not counted"""
+        if not self.max_count:
+            return None, 0
+        item = next(iter(self.count_items[self.max_count]))
+        return item, self.max_count
+
+    @property
+    def queue(self):
+        return [self.buffer[(self.head + idx) % len(self.buffer)]
+                for idx in range(self.size)]
 
     @property
     def data(self):
         return [item for item in self.queue if item is not None]
 
     def reset(self):
-        self.queue = self.queue_len * [None]
+        self.buffer = self.queue_len * [None]
+        self.head = 0
+        self.size = self.queue_len
+        # item -> count, and count -> items (a dict as an ordered set)
+        self.counts = {None: self.queue_len} if self.queue_len else dict()
+        self.count_items = dict()
+        self.max_count = 0
+
+    def __len__(self):
+        return self.size
 
     def __str__(self):
         return "[{}] {}".format(self.__class__.__name__, self.queue)
 
+    def _resize(self, capacity):
+        self.buffer = self.queue + (capacity - self.size) * [None]
+        self.head = 0
+
+    def _count(self, item, delta):
+        count = self.counts.get(item, 0)
+        new_count = count + delta
+        if new_count:
+            self.counts[item] = new_count
+        else:
+            del self.counts[item]
+        if item is None:
+            return
+
+        if count:
+            items = self.count_items[count]
+            del items[item]
+            if not len(items):
+                del self.count_items[count]
+                if count == self.max_count:
+                    self.max_count = new_count
+        if new_count:
+            self.count_items.setdefault(new_count, dict())[item] = None
+            self.max_count = max(self.max_count, new_count)
+
+
+# ------------------------------------------------------------------------------
+#  RingBuffer
+# ------------------------------------------------------------------------------
+class RingBuffer(object):
+    """
+    Fixed-capacity windows of numeric signals, e.g. scores, box coordinates
+    or speeds, for many tracks in a single preallocated array:
+        buffer (np.float32) shape [T,C,D], T tracks, window of C vectors
+        of D dims
+    Sums and sums of squares are updated on append, so mean/var/std are
+    O(1) per track. A track slot can be reused after reset([track_id]).
+    """
+
+    def __init__(self, capacity, dim=1, num_tracks=1, dtype=np.float32):
+        self.capacity = capacity
+        self.dim = dim
+        self.num_tracks = num_tracks
+        self.buffer = np.zeros([num_tracks, capacity, dim], dtype=dtype)
+        # position of the next write, the window is full at count=capacity
+        self.heads = np.zeros([num_tracks], dtype=np.int64)
+        self.counts = np.zeros([num_tracks], dtype=np.int64)
+        # float64 accumulators limit the drift of add/subtract updates
+        self.sums = np.zeros([num_tracks, dim], dtype=np.float64)
+        self.sq_sums = np.zeros([num_tracks, dim], dtype=np.float64)
+
+    def append(self, values, track_ids=None):
+        """
+        values (np.ndarray) shape [N,D], or [D] for a single track
+        track_ids (np.ndarray) shape [N], unique track slots, None is all
+            tracks in order
+        """
+        values = np.asarray(values, dtype=self.buffer.dtype)
+        values = values.reshape(-1, self.dim)
+        if track_ids is None:
+            assert len(values) == self.num_tracks
+            track_ids = np.arange(self.num_tracks)
+        else:
+            track_ids = np.asarray(track_ids, dtype=np.int64).reshape(-1)
+            assert len(values) == len(track_ids)
+
+        heads = self.heads[track_ids]
+        counts = self.counts[track_ids]
+        # slots not written yet are zeros, so they subtract nothing
+        old_values = self.buffer[track_ids, heads].astype(np.float64)
+        new_values = values.astype(np.float64)
+        self.sums[track_ids] += new_values - old_values
+        self.sq_sums[track_ids] += new_values ** 2 - old_values ** 2
+
+        self.buffer[track_ids, heads] = values
+        self.heads[track_ids] = (heads + 1) % self.capacity
+        self.counts[track_ids] = np.minimum(counts + 1, self.capacity)
+
+    def mean(self, track_ids=None):
+        """Return (np.float64) shape [N,D], NaN for empty windows"""
+        track_ids = self._get_track_ids(track_ids)
+        counts = self.counts[track_ids][:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums[track_ids] / counts
+
+    def var(self, track_ids=None):
+        """Return (np.float64) shape [N,D], population variance"""
+        track_ids = self._get_track_ids(track_ids)
+        counts = self.counts[track_ids][:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums[track_ids] / counts
+            var = self.sq_sums[track_ids] / counts - mean ** 2
+        return np.maximum(var, 0, where=~np.isnan(var), out=var)
+
+    def std(self, track_ids=None):
+        return np.sqrt(self.var(track_ids))
+
+    def median(self, track_ids=None):
+        """Return (np.float32) shape [N,D], O(C) per track, vectorized"""
+        track_ids = self._get_track_ids(track_ids)
+        windows = self.buffer[track_ids].copy()
+        # a window fills slots 0..count-1 before it wraps around
+        empty = np.arange(self.capacity)[None] >= \
+            self.counts[track_ids][:, None]
+        windows[empty] = np.nan
+        with warnings.catch_warnings():
+            # empty windows have a NaN median
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmedian(windows, axis=1)
+
+    def window(self, track_id):
+        """Return (np.float32) shape [n,D], values of a track, oldest first"""
+        count, head = self.counts[track_id], self.heads[track_id]
+        indices = (head - count + np.arange(count)) % self.capacity
+        return self.buffer[track_id, indices]
+
+    def reset(self, track_ids=None):
+        track_ids = self._get_track_ids(track_ids)
+        self.buffer[track_ids] = 0
+        self.heads[track_ids] = 0
+        self.counts[track_ids] = 0
+        self.sums[track_ids] = 0
+        self.sq_sums[track_ids] = 0
+
+    def refresh(self):
+        """Recompute sums from the windows, dropping accumulated drift"""
+        buffer = self.buffer.astype(np.float64)
+        self.sums = buffer.sum(axis=1)
+        self.sq_sums = (buffer ** 2).sum(axis=1)
+
+    def __str__(self):
+        return "[{}] capacity={}, dim={}, num_tracks={}".format(
+            self.__class__.__name__, self.capacity, self.dim,
+            self.num_tracks)
+
+    def _get_track_ids(self, track_ids):
+        if track_ids is None:
+            return np.arange(self.num_tracks)
+        return np.asarray(track_ids, dtype=np.int64).reshape(-1)
+
 
 # ------------------------------------------------------------------------------
 #  Base64 encode/decode
 # ------------------------------------------------------------------------------
 def encode_base64(image):
-    image_base64 = base64.b64encode(image.copy(order='C')).decode("utf-8")
+    # base64 reads the buffer directly, copy only non-contiguous arrays
+    image_base64 = base64.b64encode(
+        _byte_view(np.ascontiguousarray(image))).decode("utf-8")
     return image_base64
 
 
-def decode_base64(base64_code, shape, dtype='uint8'):
-    base64_code = bytes(base64_code, encoding="utf-8")
-    image = np.frombuffer(base64.decodebytes(base64_code), dtype=dtype)
+def decode_base64(base64_code, shape=None, dtype='uint8'):
+    """
+    shape None decodes a self-describing frame from encode_frame_base64
+    """
+    if shape is None:
+        return decode_frame_base64(base64_code)
+    image = np.frombuffer(base64.b64decode(base64_code), dtype=dtype)
     image = image.reshape(shape)
     return image
 
 
+# ------------------------------------------------------------------------------
+#  Binary frame encode/decode
+# ------------------------------------------------------------------------------
+# header: magic, version, compression, ndim, length of the dtype string, then
+# the dtype string (e.g. b'|u1') and the shape as uint32
+_FRAME_MAGIC = b'CV'
+_FRAME_VERSION = 1
+_FRAME_HEADER = struct.Struct('<2sBBBB')
+FRAME_COMPRESSIONS = ['none', 'zlib', 'lz4', 'jpg', 'png']
+
+
+def encode_frame(image, compression='none', level=1, quality=90,
+                 as_parts=False):
+    """
+    Encode an array with a header describing its shape, dtype and
+    compression, so the receiver needs nothing else to decode it
+    image (np.ndarray) any shape/dtype, [H,W] or [H,W,3] np.uint8 for
+        'jpg'/'png'
+    compression (str) one of FRAME_COMPRESSIONS, 'lz4' requires lz4
+    level (int) zlib/lz4 compression level
+    quality (int) JPEG quality
+    as_parts (bool) return (header, payload) without joining them, e.g. for
+        socket.sendmsg, the 'none' payload is a memoryview of image
+    """
+    assert compression in FRAME_COMPRESSIONS, \
+        "Invalid compression {}, only support {}".format(
+            compression, FRAME_COMPRESSIONS)
+    image = np.ascontiguousarray(image)
+    # the header only stores a plain dtype string, e.g. '<f4'
+    assert image.dtype.fields is None and not image.dtype.hasobject, \
+        "Structured and object dtypes are not supported, got {}".format(
+            image.dtype)
+    payload = _byte_view(image)
+    if compression == 'zlib':
+        payload = zlib.compress(payload, level)
+    elif compression == 'lz4':
+        assert lz4_frame is not None, "Compression 'lz4' requires lz4"
+        payload = lz4_frame.compress(payload, compression_level=level)
+    elif compression in ['jpg', 'png']:
+        import cv2
+        assert image.dtype == np.uint8 and image.ndim in [2, 3], \
+            "Compression '{}' requires a np.uint8 image".format(compression)
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality] \
+            if compression == 'jpg' else []
+        status, payload = cv2.imencode('.' + compression, image, params)
+        assert status, "Cannot encode image to {}".format(compression)
+        payload = memoryview(payload).cast('B')
+
+    dtype = image.dtype.str.encode('ascii')
+    header = _FRAME_HEADER.pack(
+        _FRAME_MAGIC, _FRAME_VERSION, FRAME_COMPRESSIONS.index(compression),
+        image.ndim, len(dtype)) + dtype + \
+        struct.pack('<{}I'.format(image.ndim), *image.shape)
+    if as_parts:
+        return header, payload
+    return b''.join([header, payload])
+
+
+def decode_frame(buffer):
+    """
+    buffer (bytes-like) from encode_frame
+    Return (np.ndarray), a read-only view of buffer if not compressed
+    """
+    buffer = memoryview(buffer).cast('B')
+    magic, version, compression, ndim, dtype_len = \
+        _FRAME_HEADER.unpack_from(buffer)
+    assert magic == _FRAME_MAGIC and version == _FRAME_VERSION, \
+        "Invalid frame header"
+    offset = _FRAME_HEADER.size
+    dtype = np.dtype(bytes(buffer[offset:offset + dtype_len]).decode('ascii'))
+    offset += dtype_len
+    shape = struct.unpack_from('<{}I'.format(ndim), buffer, offset)
+    payload = buffer[offset + 4 * ndim:]
+
+    compression = FRAME_COMPRESSIONS[compression]
+    if compression == 'zlib':
+        payload = zlib.decompress(payload)
+    elif compression == 'lz4':
+        assert lz4_frame is not None, "Compression 'lz4' requires lz4"
+        payload = lz4_frame.decompress(payload)
+    elif compression in ['jpg', 'png']:
+        import cv2
+        image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8),
+                             cv2.IMREAD_UNCHANGED)
+        return image.reshape(shape)
+    return np.frombuffer(payload, dtype=dtype).reshape(shape)
+
+
+def _byte_view(image):
+    """Flat uint8 memoryview of a contiguous array, no copy"""
+    return memoryview(image.reshape(-1).view(np.uint8))
+
+
+def encode_frame_base64(image, **kwargs):
+    """encode_frame for JSON transports, kwargs are passed to it"""
+    return base64.b64encode(encode_frame(image, **kwargs)).decode("utf-8")
+
+
+def decode_frame_base64(base64_code):
+    return decode_frame(base64.b64decode(base64_code))
+
+
 # ------------------------------------------------------------------------------
 #  RLE encode/decode
 # ------------------------------------------------------------------------------
@@ -85,3 +373,226 @@ def encode_rle(bin_mask):
 def decode_rle(rle):
     bin_mask = mask_util.decode(rle)
     return bin_mask
+
+
+def decode_rle_crop(rle):
+    """
+    Decode RLE only inside the bounding box of its foreground, in O(box area)
+    rle (dict) COCO RLE with 'size' [H,W] and compressed/uncompressed 'counts'
+    Return bin_mask (np.uint8) shape [h,w] and its top-left corner (x1, y1)
+    """
+    height = rle['size'][0]
+    counts = rle['counts']
+    if isinstance(counts, (bytes, str)):
+        counts = _rle_string_to_counts(counts)
+    counts = np.asarray(counts, dtype='int64')
+
+    # foreground runs in column-major order
+    ends = np.cumsum(counts)
+    starts = (ends - counts)[1::2]
+    ends = ends[1::2]
+    valid = ends > starts
+    starts, ends = starts[valid], ends[valid]
+    if len(starts) == 0:
+        return np.zeros((0, 0), dtype='uint8'), (0, 0)
+
+    # bounding box, a run spanning several columns covers all rows
+    col_starts, col_ends = starts // height, (ends - 1) // height
+    same_col = col_starts == col_ends
+    x1, x2 = col_starts.min(), col_ends.max() + 1
+    y1 = np.where(same_col, starts % height, 0).min()
+    y2 = np.where(same_col, (ends - 1) % height, height - 1).max() + 1
+    h, w = y2 - y1, x2 - x1
+
+    # runs are contiguous in the cropped column-major layout as well
+    local_starts = (col_starts - x1) * h + (starts % height - y1)
+    diff = np.zeros(h * w + 1, dtype='int32')
+    np.add.at(diff, local_starts, 1)
+    np.add.at(diff, local_starts + (ends - starts), -1)
+    bin_mask = np.cumsum(diff[:-1]).astype('uint8').reshape(w, h).T
+    return np.ascontiguousarray(bin_mask), (int(x1), int(y1))
+
+
+def _rle_string_to_counts(rle_string):
+    """Port of rleFrString from the COCO API"""
+    if isinstance(rle_string, bytes):
+        rle_string = rle_string.decode('ascii')
+    counts = []
+    pos = 0
+    while pos < len(rle_string):
+        value, k, more = 0, 0, True
+        while more:
+            c = ord(rle_string[pos]) - 48
+            value |= (c & 0x1f) << (5 * k)
+            more = c & 0x20
+            pos += 1
+            k += 1
+            if not more and (c & 0x10):
+                value |= -1 << (5 * k)
+        if len(counts) > 2:
+            value += counts[-2]
+        counts.append(value)
+    return counts
+
+
+# ------------------------------------------------------------------------------
+#  Test bench
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import time
+    from collections import Counter
+
+    class ListFIFOQueue(object):
+        """Former list-based FIFOQueue, as a reference"""
+
+        def __init__(self, queue_len):
+            self.queue = queue_len * [None]
+            self.queue_len = queue_len
+
+        def push(self, item):
+            overflow_item = None
+            while len(self.queue) >= self.queue_len:
+                overflow_item = self.queue.pop(0)
+            self.queue.append(item)
+            return overflow_item
+
+        def check_in_queue(self, item):
+            return item in self.queue
+
+        def check_unique_item(self):
+            uniq_item = self.queue[0]
+            for item in self.queue[1:]:
+                if item != uniq_item:
+                    return False, uniq_item
+            return True, uniq_item
+
+    def test_fifo_queue(num_steps=2000, queue_len=10, num_labels=4):
+        queue, ref_queue = FIFOQueue(queue_len), ListFIFOQueue(queue_len)
+        for step in range(num_steps):
+            if step % 500 == 250:
+                queue_len = np.random.randint(1, 20)
+                queue.update_queue_len(queue_len)
+                ref_queue.queue_len = queue_len
+            item = int(np.random.randint(num_labels))
+            assert queue.push(item) == ref_queue.push(item)
+            assert queue.queue == ref_queue.queue
+            assert queue.check_unique_item() == ref_queue.check_unique_item()
+            for label in [None] + list(range(num_labels)):
+                assert queue.check_in_queue(label) == \
+                    ref_queue.check_in_queue(label)
+            counts = Counter(item for item in ref_queue.queue
+                             if item is not None)
+            assert queue.most_common()[1] == max(counts.values())
+            assert counts[queue.most_common()[0]] == queue.most_common()[1]
+
+    def bench_fifo_queue(queue_class, num_tracks=1000, num_frames=100,
+                         queue_len=100):
+        queues = [queue_class(queue_len) for _ in range(num_tracks)]
+        labels = np.random.randint(0, 4, (num_frames, num_tracks)).tolist()
+        tic = time.perf_counter()
+        for frame_labels in labels:
+            for queue, label in zip(queues, frame_labels):
+                queue.push(label)
+                queue.check_in_queue(label)
+                queue.check_unique_item()
+        return (time.perf_counter() - tic) / (num_tracks * num_frames)
+
+    def test_ring_buffer(num_steps=300, capacity=16, dim=4, num_tracks=50):
+        ring = RingBuffer(capacity, dim, num_tracks)
+        windows = [[] for _ in range(num_tracks)]
+        for step in range(num_steps):
+            track_ids = np.random.choice(
+                num_tracks, np.random.randint(1, num_tracks), replace=False)
+            values = np.random.uniform(-100, 100, (len(track_ids), dim))
+            ring.append(values, track_ids)
+            for track_id, value in zip(track_ids, values):
+                windows[track_id] = \
+                    (windows[track_id] + [value.astype(np.float32)])[
+                        -capacity:]
+            if step % 100 == 50:
+                ring.reset(track_ids[:5])
+                for track_id in track_ids[:5]:
+                    windows[track_id] = []
+
+        means, stds, medians = ring.mean(), ring.std(), ring.median()
+        for track_id, window in enumerate(windows):
+            assert np.array_equal(ring.window(track_id).reshape(-1, dim),
+                                  np.array(window).reshape(-1, dim))
+            if not len(window):
+                assert np.isnan(means[track_id]).all()
+                continue
+            window = np.array(window, dtype=np.float64)
+            assert np.allclose(means[track_id], window.mean(0), atol=1e-6)
+            assert np.allclose(stds[track_id], window.std(0), atol=1e-4)
+            assert np.allclose(medians[track_id], np.median(window, 0))
+
+    def bench_ring_buffer(num_tracks=1000, num_frames=100, capacity=30):
+        ring = RingBuffer(capacity, 4, num_tracks)
+        windows = [[] for _ in range(num_tracks)]
+        values = np.random.uniform(0, 1000, (num_frames, num_tracks, 4))
+
+        tic = time.perf_counter()
+        for frame_values in values:
+            for window, value in zip(windows, frame_values.tolist()):
+                window.append(value)
+                del window[:-capacity]
+            [np.mean(window, axis=0) for window in windows]
+        runtimes = {'list': time.perf_counter() - tic}
+
+        tic = time.perf_counter()
+        for frame_values in values:
+            ring.append(frame_values)
+            ring.mean()
+        runtimes['ring'] = time.perf_counter() - tic
+        return {name: runtime / num_frames
+                for name, runtime in runtimes.items()}
+
+    def test_frame_codec():
+        image = np.random.randint(0, 256, (48, 64, 3), dtype=np.uint8)
+        image[:24] = 0
+        arrays = [image, image[:, ::2], image[..., 0],
+                  np.random.randn(5, 7).astype(np.float32), np.zeros([0, 4])]
+        compressions = ['none', 'zlib', 'png'] + \
+            (['lz4'] if lz4_frame is not None else [])
+        for array in arrays:
+            for compression in compressions:
+                if compression == 'png' and (
+                        array.dtype != np.uint8 or array.ndim < 2):
+                    continue
+                code = encode_frame(array, compression)
+                decoded = decode_frame(code)
+                assert decoded.dtype == array.dtype
+                assert np.array_equal(decoded, array)
+                assert np.array_equal(decode_frame_base64(
+                    encode_frame_base64(array, compression=compression)),
+                    array)
+                assert np.array_equal(decode_base64(
+                    encode_frame_base64(array, compression=compression)),
+                    array)
+            assert np.array_equal(decode_base64(
+                encode_base64(array), array.shape, array.dtype), array)
+        # lossy, checked on a smooth image
+        image = np.broadcast_to(np.arange(64, dtype=np.uint8)[None, :, None],
+                                (48, 64, 3))
+        for dtype in [[('a', 'i4'), ('b', 'f4')], object]:
+            try:
+                encode_frame(np.zeros(3, dtype=dtype))
+                raise RuntimeError("{} should be rejected".format(dtype))
+            except AssertionError:
+                pass
+
+        decoded = decode_frame(encode_frame(image, 'jpg', quality=95))
+        assert decoded.shape == image.shape
+        assert np.abs(decoded.astype(int) - image).mean() < 2
+
+    test_fifo_queue()
+    test_ring_buffer()
+    test_frame_codec()
+    for queue_len in [10, 100, 1000]:
+        for queue_class in [ListFIFOQueue, FIFOQueue]:
+            runtime = bench_fifo_queue(queue_class, queue_len=queue_len)
+            print("bench_fifo_queue [{}, queue_len={}]: {:.2f} us/op".format(
+                queue_class.__name__, queue_len, 1e6 * runtime))
+    for name, runtime in bench_ring_buffer().items():
+        print("bench_ring_buffer [{}]: {:.2f} ms/frame".format(
+            name, 1e3 * runtime))
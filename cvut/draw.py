@@ -2,12 +2,19 @@
 #  Libraries
 # ------------------------------------------------------------------------------
 import cv2
+import inspect
 import numpy as np
+from threading import Lock
+from functools import lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 __all__ = ["draw_bboxes", "draw_keypoints",
            "draw_inst_masks", "draw_masks_overlay", "draw_polygons",
-           "draw_reid", "draw_track"]
+           "draw_poses", "draw_reid", "draw_reid_rows", "draw_track",
+           "draw_batch", "draw_stream", "draw_preview",
+           "LabelSpriteCache", "Palette"]
 
 
 # ------------------------------------------------------------------------------
@@ -15,29 +22,392 @@ __all__ = ["draw_bboxes", "draw_keypoints",
 # ------------------------------------------------------------------------------
 _FONT = cv2.FONT_HERSHEY_SIMPLEX
 
-np.random.seed(0)
-COLOR_DICT = dict()
-for i in range(256):
-    _color_random = np.random.randint(0, 256, (3,), dtype='uint8')
-    COLOR_DICT[i] = tuple(_color_random.tolist())
+
+# ------------------------------------------------------------------------------
+#  Palette
+# ------------------------------------------------------------------------------
+class Palette(object):
+    """
+    Color palette backed by a [num_colors,3] uint8 array. Random colors are
+    drawn from its own RNG, so the global NumPy RNG is left untouched. Ids
+    (labels, track ids, instance indices) map to colors modulo num_colors.
+    """
+
+    def __init__(self, colors=None, num_colors=256, seed=0):
+        if colors is None:
+            rng = np.random.RandomState(seed)
+            colors = [rng.randint(0, 256, (3,), dtype='uint8')
+                      for _ in range(num_colors)]
+        self.colors = np.array(colors, dtype='uint8').reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.colors)
+
+    def __getitem__(self, idx):
+        """Color tuple of a single id, ready for cv2"""
+        return tuple(self.colors[int(idx) % len(self.colors)].tolist())
+
+    def lookup(self, ids):
+        """
+        ids (np.int/np.float/list) shape [...]
+        Return colors (np.uint8) shape [...,3]
+        """
+        ids = np.asarray(ids).astype(int) % len(self.colors)
+        return self.colors[ids]
+
+    def __str__(self):
+        return "[{}] num_colors={}".format(
+            self.__class__.__name__, len(self.colors))
+
+
+PALETTE = Palette()
+COLOR_DICT = {idx: PALETTE[idx] for idx in range(len(PALETTE))}
 COLOR_LEN = len(COLOR_DICT)
 
 
+def _resolve_colors(num, ids=None, color=None, palette=None):
+    """
+    Return list of color tuples len [num], color if given, otherwise palette
+    colors of ids (default range(num)) resolved in one lookup
+    """
+    if color is not None:
+        return [color] * num
+    palette = PALETTE if palette is None else palette
+    ids = np.arange(num) if ids is None else ids
+    return [tuple(_color) for _color in palette.lookup(ids).tolist()]
+
+
+# ------------------------------------------------------------------------------
+#  Output buffer
+# ------------------------------------------------------------------------------
+def _get_output(image, out=None, inplace=False):
+    """
+    Return the buffer to draw on: image itself if inplace, the caller-supplied
+    out (filled with image) if given, otherwise a fresh copy of image.
+    """
+    if inplace:
+        return image
+    if out is None:
+        return image.copy()
+    assert out.shape == image.shape and out.dtype == image.dtype, \
+        "out must have the same shape and dtype as image"
+    if out is not image:
+        np.copyto(out, image)
+    return out
+
+
+# ------------------------------------------------------------------------------
+#  Mask compositing
+# ------------------------------------------------------------------------------
+def _color_lut(colors):
+    """
+    colors (list) of color shape [3,]
+    Return [N,3] uint8 table if all colors are integers in [0;255], so that
+    blending can take the fixed-point path, otherwise the stacked colors.
+    """
+    lut = np.stack([np.asarray(color) for color in colors])
+    if np.issubdtype(lut.dtype, np.integer) and \
+            lut.min() >= 0 and lut.max() <= 255:
+        lut = lut.astype('uint8')
+    return lut
+
+
+def _blend_pixels(pixels, colors, alpha):
+    """
+    pixels (np.uint8) shape [M,3]
+    colors (np.uint8/np.float) shape [M,3] or [1,3]
+    Return alpha * pixels + (1 - alpha) * colors, truncated to uint8.
+    When alpha is a multiple of 1/256 and colors are uint8, the blend is done
+    in 8-bit fixed-point, which is bit-exact with the float computation.
+    """
+    weight = alpha * 256
+    if colors.dtype == np.uint8 and 0 <= weight <= 256 and \
+            weight == int(weight):
+        weight = int(weight)
+        blended = weight * pixels.astype('uint16') + \
+            (256 - weight) * colors.astype('uint16')
+        return (blended >> 8).astype('uint8')
+    return (alpha * pixels + (1 - alpha) * colors).astype('uint8')
+
+
+def _crop_masks(masks, height, width):
+    """
+    masks (list) of mask, each mask is either
+        dense (np.int/np.uint8/np.bool/np.float) shape [H,W]
+        RLE (dict), e.g. from cvut.data.encode_rle
+        bbox-cropped (tuple) (crop, (x1, y1)), crop shape [h,w] at (x1, y1)
+    Return crops (list) of (crop, (slice_y, slice_x)), crops clipped to the
+    image and located inside box, box (tuple) the union [x1, y1, x2, y2] of
+    crops, None if all masks are empty.
+    """
+    clipped = []
+    for mask in masks:
+        if isinstance(mask, dict):
+            from .data import decode_rle_crop
+            crop, (x1, y1) = decode_rle_crop(mask)
+        elif isinstance(mask, tuple):
+            crop, (x1, y1) = mask
+            crop, x1, y1 = np.asarray(crop), int(x1), int(y1)
+        else:
+            crop, x1, y1 = np.asarray(mask), 0, 0
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2 = min(x1 + crop.shape[1], width)
+        cy2 = min(y1 + crop.shape[0], height)
+        if cx1 >= cx2 or cy1 >= cy2:
+            clipped.append((None, cx1, cy1))
+        else:
+            clipped.append((crop[cy1-y1:cy2-y1, cx1-x1:cx2-x1], cx1, cy1))
+
+    nonempty = [item for item in clipped if item[0] is not None]
+    if len(nonempty) == 0:
+        return [], None
+    bx1 = min(x1 for (_, x1, _) in nonempty)
+    by1 = min(y1 for (_, _, y1) in nonempty)
+    bx2 = max(x1 + crop.shape[1] for (crop, x1, _) in nonempty)
+    by2 = max(y1 + crop.shape[0] for (crop, _, y1) in nonempty)
+
+    crops = []
+    for crop, x1, y1 in clipped:
+        if crop is None:
+            crop = np.zeros((0, 0), dtype='uint8')
+            x1, y1 = bx1, by1
+        crops.append((crop, (slice(y1 - by1, y1 - by1 + crop.shape[0]),
+                             slice(x1 - bx1, x1 - bx1 + crop.shape[1]))))
+    return crops, (bx1, by1, bx2, by2)
+
+
+def _composite_inst_masks(image_, masks, colors, alpha):
+    """
+    Blend masks into image_ in-place, each mask on top of the previous ones.
+    Masks are collapsed into a label map over the union box of masks, so
+    pixels covered by a single mask are blended in one vectorized pass. Only
+    overlapped pixels are blended sequentially, which keeps the output
+    identical to per-mask blending.
+    """
+    crops, box = _crop_masks(masks, *image_.shape[:2])
+    if box is None:
+        return image_
+    x1, y1, x2, y2 = box
+    region_ = image_[y1:y2, x1:x2]
+
+    labels = np.zeros(region_.shape[:2], dtype='int32')
+    counts = np.zeros(region_.shape[:2], dtype='int32')
+    for idx, (crop, crop_slice) in enumerate(crops):
+        fg = np.equal(crop, 1)
+        np.copyto(labels[crop_slice], idx + 1, where=fg)
+        counts[crop_slice] += fg
+
+    lut = _color_lut(colors)
+    single = np.nonzero(counts == 1)
+    region_[single] = _blend_pixels(
+        region_[single], lut[labels[single] - 1], alpha)
+
+    ys, xs = np.nonzero(counts > 1)
+    if len(ys):
+        pixels = region_[ys, xs]
+        for idx, (crop, (slice_y, slice_x)) in enumerate(crops):
+            crop_ys, crop_xs = ys - slice_y.start, xs - slice_x.start
+            inside = (crop_ys >= 0) & (crop_ys < crop.shape[0]) & \
+                (crop_xs >= 0) & (crop_xs < crop.shape[1])
+            fg = np.zeros(len(ys), dtype=bool)
+            fg[inside] = crop[crop_ys[inside], crop_xs[inside]] == 1
+            if fg.any():
+                pixels[fg] = _blend_pixels(pixels[fg], lut[idx:idx+1], alpha)
+        region_[ys, xs] = pixels
+    return image_
+
+
+def _composite_masks_overlay(image_, image, masks, colors, alpha):
+    """
+    Blend masks into image_ in-place, each mask replacing the previous ones.
+    Masks are collapsed into a label map and a weight map (the mask value of
+    the top-most mask) over the union box of masks, then blended in one pass.
+    """
+    crops, box = _crop_masks(masks, *image_.shape[:2])
+    if box is None:
+        return image_
+    x1, y1, x2, y2 = box
+    region_, region = image_[y1:y2, x1:x2], image[y1:y2, x1:x2]
+
+    labels = np.zeros(region_.shape[:2], dtype='int32')
+    weights = np.zeros(
+        region_.shape[:2], dtype=np.result_type(*[crop for crop, _ in crops]))
+    for idx, (crop, crop_slice) in enumerate(crops):
+        fg = crop > 0
+        np.copyto(labels[crop_slice], idx + 1, where=fg)
+        np.copyto(weights[crop_slice], crop, where=fg)
+
+    fg = np.nonzero(labels)
+    color_masks = np.stack(colors)[labels[fg] - 1]
+    mask_overlay = (weights[fg][:, None] * color_masks).astype('uint8')
+    region_[fg] = _blend_pixels(region[fg], mask_overlay, alpha)
+    return image_
+
+
+# ------------------------------------------------------------------------------
+#  LabelSpriteCache
+# ------------------------------------------------------------------------------
+class LabelSpriteCache(object):
+    """
+    Bounded LRU cache of pre-rendered text sprites, keyed by
+    (text, font, font_size, color, thickness). A sprite is the text rendered
+    once by cv2.putText into a tight alpha mask, then blitted onto images,
+    which gives the same pixels as calling cv2.putText on the image
+    (up to rounding when OpenCV renders anti-aliased text).
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._sprites = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, text, font, font_size, color, thickness):
+        """
+        Return sprite (mask, patch, alpha, (dx, dy, w, h)), dx/dy offsets of
+        the sprite box of size w/h to org.
+        mask (np.uint8) [h,w] drawn pixels, patch (np.uint8) [h,w,3] filled
+        with the color, alpha (np.uint16) [h,w,1] for anti-aliased text,
+        None otherwise
+        """
+        key = (text, font, font_size, color, thickness)
+        try:
+            sprite = self._sprites.get(key)
+        except TypeError:
+            # list or array colors are not hashable
+            color = tuple(int(ele) for ele in color)
+            key = (text, font, font_size, color, thickness)
+            sprite = self._sprites.get(key)
+        # hits skip the lock, OrderedDict operations are atomic under the GIL
+        if sprite is not None:
+            try:
+                self._sprites.move_to_end(key)
+            except KeyError:
+                pass  # evicted by another thread meanwhile
+            self.hits += 1
+            return sprite
+        with self._lock:
+            self.misses += 1
+
+        sprite = self._render(text, font, font_size, color, thickness)
+        with self._lock:
+            self._sprites[key] = sprite
+            while len(self._sprites) > self.maxsize:
+                self._sprites.popitem(last=False)
+        return sprite
+
+    def put_text(self, image, text, org, font, font_size, color, thickness):
+        """Drop-in for cv2.putText(image, text, org, ...), in-place"""
+        mask, patch, alpha, (dx, dy, w, h) = self.get(
+            text, font, font_size, color, thickness)
+        x1, y1 = int(org[0]) + dx, int(org[1]) + dy
+        x2, y2 = x1 + w, y1 + h
+
+        # OpenCV rasterizes strokes crossing the image border slightly
+        # differently, so labels partly outside the image are drawn directly
+        height, width = image.shape[:2]
+        if x1 < 0 or y1 < 0 or x2 > width or y2 > height:
+            cv2.putText(image, text, tuple(org), font, font_size, color,
+                        thickness=thickness)
+            return image
+        if not w:
+            return image
+
+        roi = image[y1:y2, x1:x2]
+        if alpha is None:
+            # masked copy in OpenCV, much cheaper than a NumPy where= copy
+            out = cv2.copyTo(patch, mask, roi)
+            if out is not roi:
+                roi[...] = out
+        else:
+            # anti-aliased text
+            blended = roi * (255 - alpha) + patch * alpha
+            roi[...] = (blended + 127) // 255
+        return image
+
+    @property
+    def stats(self):
+        """Hits are counted without the lock, approximate across threads"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.,
+            "size": len(self._sprites),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._sprites.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _render(self, text, font, font_size, color, thickness):
+        (text_w, text_h), baseline = cv2.getTextSize(
+            text, font, font_size, thickness)
+        # Hershey glyphs may overflow getTextSize, so render with a generous
+        # padding and crop to the drawn pixels afterward
+        pad = text_h + thickness + 2
+        canvas = np.zeros(
+            (text_h + baseline + 2 * pad, text_w + 2 * pad), dtype='uint8')
+        cv2.putText(canvas, text, (pad, pad + text_h),
+                    font, font_size, 255, thickness=thickness)
+
+        ys, xs = np.nonzero(canvas)
+        if len(ys) == 0:
+            mask = np.zeros((0, 0), dtype='uint8')
+            patch = np.zeros((0, 0, 3), dtype='uint8')
+            return mask, patch, None, (0, 0, 0, 0)
+        y1, y2, x1, x2 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        alpha = canvas[y1:y2, x1:x2]
+        mask = (alpha > 0).astype('uint8')
+        patch = np.empty(alpha.shape + (3,), dtype='uint8')
+        patch[...] = np.array(color, dtype='uint8')
+        if np.isin(alpha, (0, 255)).all():
+            alpha = None
+        else:
+            alpha = alpha[..., None].astype('uint16')
+        box = (int(x1) - pad, int(y1) - pad - text_h,
+               mask.shape[1], mask.shape[0])
+        return mask, patch, alpha, box
+
+    def __str__(self):
+        return "[{}] {}".format(self.__class__.__name__, self.stats)
+
+
+def _put_text(image, text, org, font, font_size, color, thickness,
+              text_cache=None):
+    if text_cache is None:
+        cv2.putText(image, text, org, font, font_size, color,
+                    thickness=thickness)
+    else:
+        text_cache.put_text(image, text, org, font, font_size, color,
+                            thickness)
+    return image
+
+
 # ------------------------------------------------------------------------------
 #  draw_bboxes
 # ------------------------------------------------------------------------------
 def draw_bboxes(image, bboxes,
                 labels=None, scores=None, classnames=None,
                 color=(0, 255, 0), thickness=1,
-                font=_FONT, font_size=0.5, font_thickness=2):
+                font=_FONT, font_size=0.5, font_thickness=2,
+                out=None, inplace=False, text_cache=None, palette=None):
     """
     image (np.uint8) shape [H,W,3], RGB image
     bboxes (np.int/np.float/list) shape [N,4], format [x1, y1, x2, y2]
     labels (np.int/list) shape [N,], start-from-0
     scores (np.float/list) shape [N,]
     classnames (list) of string, len [N,]
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    text_cache (LabelSpriteCache) cache of text sprites. None is not used.
+    palette (Palette) colors used when color is None. None is PALETTE.
     """
-    image_ = image.copy()
+    image_ = _get_output(image, out, inplace)
     if labels is None:
         for bbox in bboxes:
             x1, y1, x2, y2 = [int(ele) for ele in bbox]
@@ -45,10 +415,8 @@ def draw_bboxes(image, bboxes,
                           color, thickness=thickness)
     else:
         scores = [None] * len(bboxes) if scores is None else scores
-        for bbox, label, score in zip(bboxes, labels, scores):
-            # select color
-            color_idx = int(label % COLOR_LEN)
-            _color = COLOR_DICT[color_idx] if color is None else color
+        colors = _resolve_colors(len(bboxes), labels, color, palette)
+        for bbox, label, score, _color in zip(bboxes, labels, scores, colors):
             # draw bbox
             x1, y1, x2, y2 = [int(ele) for ele in bbox]
             cv2.rectangle(image_, (x1, y1), (x2, y2),
@@ -58,24 +426,26 @@ def draw_bboxes(image, bboxes,
             if score is not None:
                 text += "|{:.2f}".format(score)
             # draw text
-            cv2.putText(
-                image_, text, (x1, y1-2),
-                font, font_size, _color, thickness=font_thickness)
+            _put_text(image_, text, (x1, y1-2), font, font_size, _color,
+                      font_thickness, text_cache)
     return image_
 
 
 # ------------------------------------------------------------------------------
 #  draw_polygons
 # ------------------------------------------------------------------------------
-def draw_polygons(image, polygons, color=(0, 255, 0), thickness=1):
+def draw_polygons(image, polygons, color=(0, 255, 0), thickness=1,
+                  out=None, inplace=False, palette=None):
     """
     image (np.uint8) shape [H,W,3], RGB image
     polygons (list) of polygon shape [N,2], format [x, y]
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    palette (Palette) colors used when color is None. None is PALETTE.
     """
-    image_ = image.copy()
-    for idx, polygon in enumerate(polygons):
-        color_idx = int(idx % COLOR_LEN)
-        _color = COLOR_DICT[color_idx] if color is None else color
+    image_ = _get_output(image, out, inplace)
+    colors = _resolve_colors(len(polygons), None, color, palette)
+    for polygon, _color in zip(polygons, colors):
         polygon = polygon.astype(int).reshape((-1, 1, 2))
         cv2.polylines(image_, [polygon], True, _color, thickness=thickness)
     return image_
@@ -84,48 +454,54 @@ def draw_polygons(image, polygons, color=(0, 255, 0), thickness=1):
 # ------------------------------------------------------------------------------
 #  draw_inst_masks
 # ------------------------------------------------------------------------------
-def draw_inst_masks(image, masks, color=None):
+def draw_inst_masks(image, masks, color=None, out=None, inplace=False,
+                    palette=None):
     """
     image (np.uint8) shape [H,W,3], RGB image
-    masks (np.int/np.uint8/np.bool) shape [N,H,W], value in {0;1}
+    masks (np.int/np.uint8/np.bool) shape [N,H,W], value in {0;1}, or list of
+        RLE dicts/bbox-cropped masks (crop, (x1, y1)), len [N,]
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    palette (Palette) colors used when color is None. None is PALETTE.
     """
-    image_ = image.copy()
-
-    for idx, mask in enumerate(masks):
-        if color is not None:
-            color_mask = np.array(color)
-        else:
-            color_mask = np.array(COLOR_DICT[idx])
+    image_ = _get_output(image, out, inplace)
+    if len(masks) == 0:
+        return image_
 
-        image_[mask == 1] = image_[mask == 1] * 0.5 + color_mask * 0.5
+    if color is not None:
+        colors = [np.array(color)] * len(masks)
+    else:
+        palette = PALETTE if palette is None else palette
+        colors = palette.lookup(np.arange(len(masks)))
 
+    _composite_inst_masks(image_, masks, colors, alpha=0.5)
     return image_
 
 
 # ------------------------------------------------------------------------------
 #  draw_masks_overlay
 # ------------------------------------------------------------------------------
-def draw_masks_overlay(image, masks, color=None, alpha=0.5):
+def draw_masks_overlay(image, masks, color=None, alpha=0.5,
+                       out=None, inplace=False, palette=None):
     """
     image (np.uint8) shape [H,W,3], RGB image
     masks (np.int/np.uint8/np.bool/np.float) shape [N,H,W], value in range [0;1]
+        or list of RLE dicts/bbox-cropped masks (crop, (x1, y1)), len [N,]
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    palette (Palette) colors used when color is None. None is PALETTE.
     """
-    image_ = image.copy()
+    image_ = _get_output(image, out, inplace)
+    if len(masks) == 0:
+        return image_
 
-    np.random.seed(0)
     if color is not None:
         color_masks = [np.array(color)] * len(masks)
     else:
-        color_masks = [
-            np.random.randint(0, 256, (3,), dtype='uint8')
-            for _ in range(len(masks))]
-
-    for mask, color_mask in zip(masks, color_masks):
-        mask_overlay = (mask[..., None] * color_mask[None, None, ...])
-        mask_overlay = mask_overlay.astype('uint8')
-        image_[mask > 0, ...] = alpha * image[mask > 0, ...] + \
-            (1-alpha) * mask_overlay[mask > 0, ...]
+        palette = PALETTE if palette is None else palette
+        color_masks = palette.lookup(np.arange(len(masks)))
 
+    _composite_masks_overlay(image_, image, masks, color_masks, alpha)
     return image_
 
 
@@ -134,54 +510,57 @@ def draw_masks_overlay(image, masks, color=None, alpha=0.5):
 # ------------------------------------------------------------------------------
 def draw_track(image, bboxes, ids, labels=None, classnames=None,
                masks=None, polygons=None, thickness=1,
-               color=None, font=_FONT, font_size=0.5, font_thickness=1):
+               color=None, font=_FONT, font_size=0.5, font_thickness=1,
+               out=None, inplace=False, text_cache=None, palette=None):
     """
     image (np.uint8) shape [H,W,3], RGB image
     bboxes (np.int/np.float/list) shape [N,4], format [x1, y1, x2, y2]
     ids (np.int/np.float/list) shape [N]
     labels (np.int/list) shape [N,], start-from-0. None is not used.
     classnames (list) of string, len [N,]. None is not used.
-    masks (np.int/np.float/list) [N, H, W]
+    masks (np.int/np.float/list) [N, H, W], or list of RLE dicts/bbox-cropped
+        masks (crop, (x1, y1)), len [N,]
     polygons (list) list of [K, 2]
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    text_cache (LabelSpriteCache) cache of text sprites. None is not used.
+    palette (Palette) colors used when color is None. None is PALETTE.
     """
-    image_ = image.copy()
+    image_ = _get_output(image, out, inplace)
+    colors = _resolve_colors(len(ids), ids, color, palette)
 
     if bboxes is not None:
         if labels is None:
-            for bbox, track_id in zip(bboxes, ids):
+            for bbox, track_id, _color in zip(bboxes, ids, colors):
                 track_id = int(track_id)
                 x1, y1, x2, y2 = [int(ele) for ele in bbox]
-                _color = COLOR_DICT[track_id % len(COLOR_DICT)] if color is None else color
                 cv2.rectangle(image_, (x1, y1), (x2, y2),
                               _color, thickness=thickness)
-                cv2.putText(image_, "ID{}".format(track_id),
-                            (int((x1+x2)/2), int((y1+y2)/2)),
-                            font, font_size, _color, thickness=font_thickness)
+                _put_text(image_, "ID{}".format(track_id),
+                          (int((x1+x2)/2), int((y1+y2)/2)),
+                          font, font_size, _color, font_thickness, text_cache)
         else:
-            for bbox, track_id, label in zip(bboxes, ids, labels):
+            for bbox, track_id, label, _color in zip(
+                    bboxes, ids, labels, colors):
                 label = int(label)
                 track_id = int(track_id)
                 x1, y1, x2, y2 = [int(ele) for ele in bbox]
-                _color = COLOR_DICT[track_id % len(COLOR_DICT)] if color is None else color
                 cv2.rectangle(image_, (x1, y1), (x2, y2),
                               _color, thickness=thickness)
                 text = "cls{}-ID{}".format(label, track_id) if classnames is None \
                     else "{}-ID{}".format(classnames[label], track_id)
-                cv2.putText(
-                    image_, text, (int((x1+x2)/2), int((y1+y2)/2)),
-                    font, font_size, _color, thickness=font_thickness)
+                _put_text(image_, text, (int((x1+x2)/2), int((y1+y2)/2)),
+                          font, font_size, _color, font_thickness, text_cache)
 
     if masks is not None:
-        for track_id, mask in zip(ids, masks):
-            _color = COLOR_DICT[track_id % len(COLOR_DICT)] if color is None else color
-            image_ = draw_masks_overlay(
-                image_, np.expand_dims(mask, axis=0), color=_color)
+        for mask, _color in zip(masks, colors):
+            draw_masks_overlay(image_, [mask], color=_color, inplace=True)
 
     if polygons is not None:
-        for track_id, polygon in zip(ids, polygons):
-            _color = COLOR_DICT[track_id % len(COLOR_DICT)] if color is None else color
-            image_ = draw_polygons(
-                image_, [polygon], color=_color, thickness=thickness)
+        for polygon, _color in zip(polygons, colors):
+            draw_polygons(
+                image_, [polygon], color=_color, thickness=thickness,
+                inplace=True)
 
     return image_
 
@@ -191,20 +570,34 @@ def draw_track(image, bboxes, ids, labels=None, classnames=None,
 # ------------------------------------------------------------------------------
 def draw_keypoints(image, points_list, ids=None,
                    scale=1.0, radius=1, color=(0, 255, 0),
-                   put_text=False, font=_FONT, font_size=0.5, font_thickness=1):
+                   put_text=False, font=_FONT, font_size=0.5, font_thickness=1,
+                   out=None, inplace=False, palette=None):
     """
     image (np.uint8) shape [H,W,3], RGB image
     points_list (list) shape [num_points,3] format [x,y,visible]/[num_points,2]
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    palette (Palette) colors used when color is None. None is PALETTE.
     """
-    image_ = image.copy()
-    for idx in range(len(points_list)):
+    image_ = _get_output(image, out, inplace)
+    colors = _keypoint_colors(len(points_list), ids, color, palette)
 
-        if ids is not None:
-            color_idx = int(ids[idx] % COLOR_LEN)
-        else:
-            color_idx = int(idx % COLOR_LEN)
-        _color = COLOR_DICT[color_idx] if color is None else color
+    # without text, all points are stamped in bulk
+    if not put_text:
+        xys, point_colors = [], []
+        for points, _color in zip(points_list, colors):
+            if len(points) == 0:
+                continue
+            xy, visible = _scale_keypoints(points, scale)
+            xys.append(xy[visible])
+            point_colors.append(np.repeat(_color[None], visible.sum(), 0))
+        if len(xys):
+            _stamp_discs(image_, np.concatenate(xys),
+                         np.concatenate(point_colors), radius)
+        return image_
 
+    for idx in range(len(points_list)):
+        _color = tuple(colors[idx].tolist())
         points = points_list[idx]
         for point_id, point in enumerate(points):
 
@@ -216,9 +609,100 @@ def draw_keypoints(image, points_list, ids=None,
 
             if visible != 0:
                 image_ = cv2.circle(image_, (x, y), radius, _color, -1)
-                if put_text:
-                    image_ = cv2.putText(image_, str(point_id+1),
-                                         (x, y), font, font_size, _color, font_thickness)
+                image_ = cv2.putText(image_, str(point_id+1),
+                                     (x, y), font, font_size, _color, font_thickness)
+    return image_
+
+
+# ------------------------------------------------------------------------------
+#  draw_poses
+# ------------------------------------------------------------------------------
+def draw_poses(image, keypoints, ids=None, skeleton=None,
+               scale=1.0, radius=1, color=(0, 255, 0), thickness=1,
+               out=None, inplace=False, palette=None):
+    """
+    Vectorized keypoint and skeleton rendering, joints are drawn on top of
+    limbs and look the same as draw_keypoints.
+    image (np.uint8) shape [H,W,3], RGB image
+    keypoints (np.float) shape [P,K,3] format [x,y,visible]/[P,K,2]
+    ids (np.int/list) shape [P,], used to select colors. None is not used.
+    skeleton (list) of limb (i, j), indices of the two joints in [0;K)
+    out (np.uint8) shape [H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on image
+    palette (Palette) colors used when color is None. None is PALETTE.
+    """
+    image_ = _get_output(image, out, inplace)
+    keypoints = np.asarray(keypoints)
+    num_persons, num_joints = keypoints.shape[:2]
+    if num_persons * num_joints == 0:
+        return image_
+    colors = _keypoint_colors(num_persons, ids, color, palette)
+    xy, visible = _scale_keypoints(keypoints, scale)
+
+    # limbs, one batched polylines call per person
+    if skeleton is not None and len(skeleton):
+        skeleton = np.asarray(skeleton, dtype=int).reshape(-1, 2)
+        limbs = xy[:, skeleton].astype('int32')
+        valid = visible[:, skeleton[:, 0]] & visible[:, skeleton[:, 1]]
+        for person_limbs, person_valid, _color in zip(limbs, valid, colors):
+            if person_valid.any():
+                cv2.polylines(image_, list(person_limbs[person_valid]), False,
+                              tuple(_color.tolist()), thickness=thickness)
+
+    # joints
+    point_colors = np.repeat(colors, num_joints, axis=0)
+    visible = visible.reshape(-1)
+    _stamp_discs(image_, xy.reshape(-1, 2)[visible],
+                 point_colors[visible], radius)
+    return image_
+
+
+def _keypoint_colors(num_persons, ids=None, color=None, palette=None):
+    """Return colors (np.uint8) shape [P,3]"""
+    if color is not None:
+        return np.tile(np.array(color, dtype='uint8'), (num_persons, 1))
+    palette = PALETTE if palette is None else palette
+    ids = np.arange(num_persons) if ids is None else ids[:num_persons]
+    return palette.lookup(ids).reshape(-1, 3)
+
+
+def _scale_keypoints(keypoints, scale):
+    """
+    keypoints (np.float) shape [...,3] format [x,y,visible]/[...,2]
+    Return xy (np.int) shape [...,2] and visible (np.bool) shape [...],
+    truncated like int(scale * ele)
+    """
+    keypoints = (scale * np.asarray(keypoints, dtype=float)).astype(int)
+    if keypoints.shape[-1] == 3:
+        visible = keypoints[..., 2] != 0
+    else:
+        visible = np.ones(keypoints.shape[:-1], dtype=bool)
+    return keypoints[..., :2], visible
+
+
+@lru_cache(maxsize=32)
+def _disc_offsets(radius):
+    """Pixel offsets (dy, dx) of a filled disc rasterized by cv2.circle"""
+    size = 2 * radius + 1
+    canvas = np.zeros((size, size), dtype='uint8')
+    cv2.circle(canvas, (radius, radius), radius, 255, -1)
+    dys, dxs = np.nonzero(canvas)
+    return dys - radius, dxs - radius
+
+
+def _stamp_discs(image_, points, colors, radius):
+    """
+    Stamp pre-rasterized filled discs in bulk, later points on top
+    points (np.int) shape [M,2], format [x, y]
+    colors (np.uint8) shape [M,3]
+    """
+    height, width = image_.shape[:2]
+    dys, dxs = _disc_offsets(radius)
+    ys = points[:, 1, None] + dys[None]
+    xs = points[:, 0, None] + dxs[None]
+    inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+    colors = np.broadcast_to(colors[:, None], ys.shape + (3,))
+    image_[ys[inside], xs[inside]] = colors[inside]
     return image_
 
 
@@ -226,22 +710,454 @@ def draw_keypoints(image, points_list, ids=None,
 #  draw_reid
 # ------------------------------------------------------------------------------
 def draw_reid(img_files, sims, descending=True, topk=10, h=200, w=100,
-              color=(0, 255, 0), font=_FONT, font_size=0.8, font_thickness=2):
+              color=(0, 255, 0), font=_FONT, font_size=0.8, font_thickness=2,
+              num_workers=8):
+    """
+    img_files (list) of image file, len [N,]
+    sims (np.float) shape [N,N], similarity matrix
+    Return gallery (np.uint8) shape [N*h,topk*w,3], row i shows the topk
+    images most similar to image i
+    """
+    num_imgs = len(img_files)
+    topk = min(topk, num_imgs)
+    total_img = np.zeros([h*num_imgs, w*topk, 3], dtype='uint8')
+    rows = draw_reid_rows(
+        img_files, sims, descending=descending, topk=topk, h=h, w=w,
+        color=color, font=font, font_size=font_size,
+        font_thickness=font_thickness, num_workers=num_workers,
+        out=total_img)
+    for _ in rows:
+        pass
+    return total_img
+
+
+def draw_reid_rows(img_files, sims, descending=True, topk=10, h=200, w=100,
+                   color=(0, 255, 0), font=_FONT, font_size=0.8,
+                   font_thickness=2, num_workers=8, chunk_size=64, out=None,
+                   cache_size=None):
+    """
+    Stream the gallery of draw_reid row by row, so that large galleries
+    never sit in memory at once. Images are decoded in parallel, chunk by
+    chunk of rows, and their resized thumbnails are kept in an LRU cache.
+    out (np.uint8) shape [N*h,topk*w,3], rows are written into it if given
+    cache_size (int) maximum number of cached thumbnails, at least those of
+        the current chunk. None is chunk_size*topk
+    Yield (i, row) with row (np.uint8) shape [h,topk*w,3]
+    """
     num_imgs = len(img_files)
     topk = min(topk, num_imgs)
-    imgs = [cv2.imread(img_file) for img_file in img_files]
+    sims = np.asarray(sims)
+    cache_size = chunk_size * topk if cache_size is None else cache_size
+    thumbs = OrderedDict()
 
-    total_img = np.zeros([h*num_imgs, w*topk, 3])
-    for i in range(len(imgs)):
-        if descending:
-            sort_ids = np.argsort(-sims[i])[:topk]
+    def _load_thumb(idx):
+        return idx, cv2.resize(cv2.imread(img_files[idx]), (w, h))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start in range(0, num_imgs, chunk_size):
+            # select topk per row, then sort only the topk
+            scores = sims[start:start+chunk_size]
+            scores = -scores if descending else scores
+            sort_ids = np.argpartition(scores, topk-1, axis=1)[:, :topk]
+            order = np.argsort(
+                np.take_along_axis(scores, sort_ids, axis=1), axis=1)
+            sort_ids = np.take_along_axis(sort_ids, order, axis=1)
+
+            # decode missing thumbnails in parallel, then evict the least
+            # recently used ones the chunk does not need
+            needed = np.unique(sort_ids).tolist()
+            missing = []
+            for idx in needed:
+                if idx in thumbs:
+                    thumbs.move_to_end(idx)
+                else:
+                    missing.append(idx)
+            thumbs.update(executor.map(_load_thumb, missing))
+            while len(thumbs) > max(cache_size, len(needed)):
+                thumbs.popitem(last=False)
+
+            for i, row_ids in enumerate(sort_ids, start=start):
+                if out is None:
+                    row = np.empty([h, w*topk, 3], dtype='uint8')
+                else:
+                    row = out[i*h:(i+1)*h]
+                for j, idx in enumerate(row_ids):
+                    img_j = thumbs[idx].copy()
+                    cv2.putText(
+                        img_j, "{:.2f}".format(sims[i][idx]), (w//5, h//3),
+                        font, font_size, color, thickness=font_thickness)
+                    row[:, j*w:(j+1)*w] = img_j
+                yield i, row
+
+
+# ------------------------------------------------------------------------------
+#  draw_batch
+# ------------------------------------------------------------------------------
+def draw_batch(images, detections, draw_fn=draw_track, num_workers=4,
+               out=None, inplace=False):
+    """
+    Render a batch of frames across a thread pool, cv2 releases the GIL.
+    images (np.uint8) shape [B,H,W,3], RGB images
+    detections (list) of dict, len [B,], keyword arguments of draw_fn for
+        each frame, e.g. dict(bboxes=bboxes, ids=ids)
+    draw_fn (callable) draw_* function supporting out/inplace
+    num_workers (int) number of threads
+    out (np.uint8) shape [B,H,W,3], output buffer. None is not used.
+    inplace (bool) draw directly on images
+    """
+    assert len(images) == len(detections)
+    if inplace:
+        out_ = images
+    elif out is None:
+        out_ = np.empty_like(images)
+    else:
+        assert len(out) == len(images)
+        out_ = out
+
+    def _draw(idx):
+        if inplace:
+            draw_fn(images[idx], inplace=True, **detections[idx])
         else:
-            sort_ids = np.argsort(sims[i])[:topk]
-        for j in range(topk):
-            img_j = cv2.resize(imgs[sort_ids[j]], (w, h))
-            cv2.putText(
-                img_j, "{:.2f}".format(sims[i][sort_ids[j]]), (w//5, h//3),
-                _FONT, font_size, color, thickness=font_thickness)
-            total_img[i*h:(i+1)*h, j*w:(j+1)*w] = img_j
+            draw_fn(images[idx], out=out_[idx], **detections[idx])
 
-    return total_img
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # consume the iterator to raise exceptions from workers
+        list(executor.map(_draw, range(len(images))))
+    return out_
+
+
+# ------------------------------------------------------------------------------
+#  draw_stream
+# ------------------------------------------------------------------------------
+def draw_stream(frames, detections, draw_fn=draw_track, num_workers=4,
+                max_pending=None, inplace=False):
+    """
+    Render frames across a thread pool, yielding them in the input order, e.g.
+        for frame in draw_stream(frames, detections):
+            out.write(frame)  # out = cvut.video.create_video(...)
+    frames (iterable) of np.uint8 shape [H,W,3], RGB images
+    detections (iterable) of dict, keyword arguments of draw_fn per frame
+    draw_fn (callable) draw_* function supporting inplace
+    num_workers (int) number of threads
+    max_pending (int) max frames in flight, default 2*num_workers
+    inplace (bool) draw directly on frames
+    """
+    max_pending = 2 * num_workers if max_pending is None else max_pending
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for frame, kwargs in zip(frames, detections):
+            pending.append(executor.submit(
+                draw_fn, frame, inplace=inplace, **kwargs))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
+
+
+# ------------------------------------------------------------------------------
+#  draw_preview
+# ------------------------------------------------------------------------------
+_PREVIEW_STYLE_KEYS = ['thickness', 'radius', 'font_size', 'font_thickness']
+
+
+def draw_preview(image, size, draw_fn=draw_track, interpolation=cv2.INTER_AREA,
+                 scale_style=True, **kwargs):
+    """
+    Resize image to the display size first, then draw the scaled annotations
+    at that size, e.g. for a window from cvut.video.setup_cv2_window. The
+    overlay cost depends on display pixels instead of sensor pixels, and the
+    output looks the same as drawing at full size then resizing.
+    image (np.uint8) shape [H,W,3], RGB image
+    size (tuple) display size (width, height)
+    draw_fn (callable) draw_* function supporting inplace
+    scale_style (bool) also scale thickness, radius and font sizes
+    kwargs: keyword arguments of draw_fn in image coordinates, bboxes,
+        polygons, masks, points_list and keypoints are scaled to size
+    """
+    height, width = image.shape[:2]
+    scale_x, scale_y = size[0] / width, size[1] / height
+    preview = cv2.resize(image, tuple(size), interpolation=interpolation)
+
+    if kwargs.get('bboxes') is not None and len(kwargs['bboxes']):
+        bboxes = np.array(kwargs['bboxes'], dtype=float).reshape(
+            len(kwargs['bboxes']), -1)
+        bboxes[:, :4] *= [scale_x, scale_y, scale_x, scale_y]
+        kwargs['bboxes'] = bboxes
+    if kwargs.get('polygons') is not None:
+        kwargs['polygons'] = [
+            _scale_points(polygon, scale_x, scale_y)
+            for polygon in kwargs['polygons']]
+    if kwargs.get('points_list') is not None:
+        kwargs['points_list'] = [
+            _scale_points(points, scale_x, scale_y)
+            for points in kwargs['points_list']]
+    if kwargs.get('keypoints') is not None:
+        kwargs['keypoints'] = _scale_points(
+            kwargs['keypoints'], scale_x, scale_y)
+    if kwargs.get('masks') is not None:
+        kwargs['masks'] = _resize_masks(kwargs['masks'], scale_x, scale_y)
+
+    if scale_style:
+        style_scale = min(scale_x, scale_y)
+        params = inspect.signature(draw_fn).parameters
+        for key in _PREVIEW_STYLE_KEYS:
+            if key not in params:
+                continue
+            value = kwargs.get(key, params[key].default)
+            if key == 'font_size':
+                kwargs[key] = value * style_scale
+            elif value > 0:
+                kwargs[key] = max(1, int(round(value * style_scale)))
+
+    return draw_fn(preview, inplace=True, **kwargs)
+
+
+def _scale_points(points, scale_x, scale_y):
+    """Scale [x,y] of points shape [...,2]/[...,3], visible is unchanged"""
+    points = np.array(points, dtype=float)
+    if points.size:
+        points[..., :2] *= [scale_x, scale_y]
+    return points
+
+
+def _nearest_indices(start, length, scale):
+    """
+    Nearest-neighbor resampling of the range [start, start + length)
+    Return the resampled start and the source indices relative to start
+    """
+    new_start = int(np.ceil(start * scale - 0.5))
+    new_stop = int(np.ceil((start + length) * scale - 0.5))
+    indices = np.floor(
+        (np.arange(new_start, new_stop) + 0.5) / scale).astype(int) - start
+    return new_start, np.clip(indices, 0, max(length - 1, 0))
+
+
+def _resize_masks(masks, scale_x, scale_y):
+    """
+    Nearest-neighbor resize of masks accepted by draw_inst_masks, dense
+    [N,H,W] arrays stay dense, other masks become bbox-cropped masks
+    """
+    if isinstance(masks, np.ndarray) and masks.ndim == 3:
+        _, ys = _nearest_indices(0, masks.shape[1], scale_y)
+        _, xs = _nearest_indices(0, masks.shape[2], scale_x)
+        return masks[:, ys[:, None], xs[None, :]]
+
+    resized = []
+    for mask in masks:
+        if isinstance(mask, dict):
+            from .data import decode_rle_crop
+            crop, (x1, y1) = decode_rle_crop(mask)
+        elif isinstance(mask, tuple):
+            crop, (x1, y1) = mask
+            crop = np.asarray(crop)
+        else:
+            crop, x1, y1 = np.asarray(mask), 0, 0
+        new_y1, ys = _nearest_indices(y1, crop.shape[0], scale_y)
+        new_x1, xs = _nearest_indices(x1, crop.shape[1], scale_x)
+        if len(ys) == 0 or len(xs) == 0:
+            crop = np.zeros((0, 0), dtype=crop.dtype)
+        else:
+            crop = crop[ys[:, None], xs[None, :]]
+        resized.append((crop, (new_x1, new_y1)))
+    return resized
+
+
+# ------------------------------------------------------------------------------
+#  Test bench
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import time
+
+    # reference per-mask and per-point loops drawn by the previous versions
+    def ref_draw_inst_masks(image, masks, color=None):
+        image_ = image.copy()
+        for idx, mask in enumerate(masks):
+            color_mask = np.array(color) if color is not None \
+                else np.array(COLOR_DICT[idx])
+            image_[mask == 1] = image_[mask == 1] * 0.5 + color_mask * 0.5
+        return image_
+
+    def ref_draw_masks_overlay(image, masks, color=None, alpha=0.5):
+        image_ = image.copy()
+        color_masks = [np.array(color)] * len(masks) if color is not None \
+            else [np.array(COLOR_DICT[idx]) for idx in range(len(masks))]
+        for mask, color_mask in zip(masks, color_masks):
+            mask_overlay = (mask[..., None] *
+                            color_mask[None, None, ...]).astype('uint8')
+            image_[mask > 0, ...] = alpha * image[mask > 0, ...] + \
+                (1-alpha) * mask_overlay[mask > 0, ...]
+        return image_
+
+    def ref_draw_keypoints(image, points_list, ids=None, scale=1.0, radius=1,
+                           color=(0, 255, 0), put_text=False, font=_FONT,
+                           font_size=0.5, font_thickness=1):
+        image_ = image.copy()
+        for idx in range(len(points_list)):
+            color_idx = int(ids[idx] % COLOR_LEN) if ids is not None \
+                else int(idx % COLOR_LEN)
+            _color = COLOR_DICT[color_idx] if color is None else color
+            for point_id, point in enumerate(points_list[idx]):
+                if len(point) == 3:
+                    x, y, visible = [int(scale * ele) for ele in point]
+                else:
+                    x, y = [int(scale * ele) for ele in point]
+                    visible = 1
+                if visible != 0:
+                    image_ = cv2.circle(image_, (x, y), radius, _color, -1)
+                    if put_text:
+                        image_ = cv2.putText(image_, str(point_id+1), (x, y),
+                                             font, font_size, _color,
+                                             font_thickness)
+        return image_
+
+    def ref_draw_poses(image, keypoints, ids=None, skeleton=None, scale=1.0,
+                       radius=1, color=(0, 255, 0), thickness=1):
+        image_ = image.copy()
+        for idx, points in enumerate(keypoints):
+            color_idx = int(ids[idx] % COLOR_LEN) if ids is not None \
+                else int(idx % COLOR_LEN)
+            _color = COLOR_DICT[color_idx] if color is None else color
+            for i, j in skeleton:
+                pt1 = [int(scale * ele) for ele in points[i]]
+                pt2 = [int(scale * ele) for ele in points[j]]
+                if len(pt1) == 3 and (pt1[2] == 0 or pt2[2] == 0):
+                    continue
+                image_ = cv2.line(image_, tuple(pt1[:2]), tuple(pt2[:2]),
+                                  _color, thickness)
+        return ref_draw_keypoints(image_, keypoints, ids, scale, radius, color)
+
+    def paste_mask(mask, height, width):
+        crop, (x1, y1) = mask
+        dense = np.zeros((height, width), dtype=crop.dtype)
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2 = min(x1 + crop.shape[1], width)
+        cy2 = min(y1 + crop.shape[0], height)
+        if cx1 < cx2 and cy1 < cy2:
+            dense[cy1:cy2, cx1:cx2] = crop[cy1-y1:cy2-y1, cx1-x1:cx2-x1]
+        return dense
+
+    def test_masks_reference():
+        from .data import encode_rle
+        rng = np.random.RandomState(0)
+        height, width = 120, 160
+        image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+
+        # overlapping bbox-cropped masks, some crossing or outside the border
+        boxes = [(10, 10, 80, 60), (40, 30, 120, 100), (-20, -15, 30, 40),
+                 (130, 90, 200, 150), (50, 40, 70, 55), (170, 10, 190, 30)]
+        crops = []
+        for x1, y1, x2, y2 in boxes:
+            crop = (rng.rand(y2 - y1, x2 - x1) > 0.3).astype(np.uint8)
+            crops.append((crop, (x1, y1)))
+        dense = np.stack([paste_mask(crop, height, width) for crop in crops])
+        rles = [encode_rle(mask) for mask in dense]
+        soft = dense * rng.rand(*dense.shape)
+        soft_crops = [(crop * rng.rand(*crop.shape), org)
+                      for crop, org in crops]
+        soft_dense = np.stack([paste_mask(crop, height, width)
+                               for crop in soft_crops])
+
+        for color in [None, (255, 0, 0)]:
+            ref = ref_draw_inst_masks(image, dense, color=color)
+            for masks in [dense, dense.astype(bool), dense.astype(float),
+                          list(dense), rles, crops]:
+                out = draw_inst_masks(image, masks, color=color)
+                assert np.array_equal(out, ref)
+            for masks, refs in [(dense, dense), (rles, dense),
+                                (crops, dense), (soft, soft),
+                                (soft_crops, soft_dense)]:
+                for alpha in [0.5, 0.3]:
+                    ref = ref_draw_masks_overlay(image, refs, color=color,
+                                                 alpha=alpha)
+                    out = draw_masks_overlay(image, masks, color=color,
+                                             alpha=alpha)
+                    assert np.array_equal(out, ref)
+
+    def test_keypoints_reference():
+        rng = np.random.RandomState(0)
+        height, width = 120, 160
+        image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+
+        # persons partly off-frame, joints with fractional and negative coords
+        keypoints = np.concatenate([
+            rng.uniform(-30, 190, (4, 17, 1)),
+            rng.uniform(-30, 150, (4, 17, 1)),
+            rng.randint(0, 3, (4, 17, 1))], axis=-1)
+        skeleton = [(0, 1), (1, 2), (2, 3), (3, 4), (5, 6), (5, 7), (7, 9),
+                    (6, 8), (8, 10), (11, 12), (11, 13), (13, 15), (12, 14),
+                    (14, 16), (5, 11), (6, 12)]
+        ids = np.array([3, 25, 7, 100])
+        for points_list in [keypoints, keypoints[..., :2], list(keypoints)]:
+            for kwargs in [dict(), dict(color=None), dict(color=None, ids=ids),
+                           dict(scale=0.7, radius=3),
+                           dict(scale=1.5, radius=0, color=(0, 0, 255)),
+                           dict(put_text=True, color=None, ids=ids)]:
+                ref = ref_draw_keypoints(image, points_list, **kwargs)
+                out = draw_keypoints(image, points_list, **kwargs)
+                assert np.array_equal(out, ref)
+        for points in [keypoints, keypoints[..., :2]]:
+            for kwargs in [dict(), dict(color=None, ids=ids, radius=2),
+                           dict(scale=0.7, thickness=2, color=None)]:
+                ref = ref_draw_poses(image, points, skeleton=skeleton,
+                                     **kwargs)
+                out = draw_poses(image, points, skeleton=skeleton, **kwargs)
+                assert np.array_equal(out, ref)
+
+    def test_preview_empty():
+        image = np.zeros((240, 320, 3), dtype=np.uint8)
+        for bboxes in [[], np.zeros((0, 4)), np.zeros((0, 5))]:
+            preview = draw_preview(image, (80, 60), bboxes=bboxes, ids=[])
+            assert preview.shape == (60, 80, 3)
+        preview = draw_preview(image, (80, 60), draw_fn=draw_poses,
+                               keypoints=np.zeros((0, 17, 3)))
+        assert preview.shape == (60, 80, 3)
+
+    def test_label_sprite_cache():
+        image = np.random.randint(0, 256, (240, 320, 3), dtype=np.uint8)
+        cache = LabelSpriteCache(maxsize=2)
+        texts = ["ID1", "cls3-ID42", "ID1", "cls3-ID42", "person"]
+        for font_size, thickness in [(0.5, 1), (0.5, 2), (2.0, 3)]:
+            cache.clear()
+            for text in texts:
+                # the last org crosses the border, drawn by cv2.putText
+                for org in [(20, 100), (150, 60), (300, 20)]:
+                    ref = cv2.putText(image.copy(), text, org, _FONT,
+                                      font_size, (0, 255, 0), thickness)
+                    out = cache.put_text(image.copy(), text, org, _FONT,
+                                         font_size, [0, 255, 0], thickness)
+                    assert np.array_equal(out, ref)
+            # one miss per text, then hits until evicted by maxsize=2
+            assert cache.stats["misses"] == 3 and cache.stats["hits"] == 12
+            assert cache.stats["size"] == 2
+
+    def bench_label_sprite_cache(num_runs=10000):
+        image = np.zeros((1080, 1920, 3), dtype=np.uint8)
+        runtimes = dict()
+        for font_size, thickness in [(0.5, 1), (0.5, 2), (2.0, 3)]:
+            cache = LabelSpriteCache()
+            args = ("cls3-ID42", (500, 500), _FONT, font_size, (0, 255, 0))
+            tic = time.perf_counter()
+            for _ in range(num_runs):
+                cv2.putText(image, *args, thickness=thickness)
+            runtime = time.perf_counter() - tic
+            tic = time.perf_counter()
+            for _ in range(num_runs):
+                cache.put_text(image, *args, thickness)
+            runtimes[(font_size, thickness)] = \
+                (runtime, time.perf_counter() - tic)
+        return {key: (putText / num_runs, cache / num_runs)
+                for key, (putText, cache) in runtimes.items()}
+
+    test_masks_reference()
+    print("test_masks_reference: passed")
+    test_keypoints_reference()
+    print("test_keypoints_reference: passed")
+    test_preview_empty()
+    print("test_preview_empty: passed")
+    test_label_sprite_cache()
+    print("test_label_sprite_cache: passed")
+    for (font_size, thickness), (putText, cache) in \
+            bench_label_sprite_cache().items():
+        print("bench_label_sprite_cache [font_size={}, thickness={}]: "
+              "cv2.putText {:.1f} us, cache {:.1f} us".format(
+                  font_size, thickness, 1e6 * putText, 1e6 * cache))
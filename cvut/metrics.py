@@ -0,0 +1,236 @@
+# ------------------------------------------------------------------------------
+#  Libraries
+# ------------------------------------------------------------------------------
+import os
+from time import time
+from bisect import bisect_left
+from threading import Lock, Thread
+from urllib.parse import urlsplit, urlunsplit
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+__all__ = ["Histogram", "StreamStats", "strip_userinfo",
+           "to_prometheus", "export_prometheus", "serve_prometheus"]
+
+
+# ------------------------------------------------------------------------------
+#  Constants
+# ------------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+# ------------------------------------------------------------------------------
+#  Histogram
+# ------------------------------------------------------------------------------
+class Histogram(object):
+    """Histogram with fixed upper bounds, cumulative as in Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative, total = dict(), 0
+        for bucket, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative[bucket] = total
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.,
+            "buckets": cumulative,
+        }
+
+
+# ------------------------------------------------------------------------------
+#  StreamStats
+# ------------------------------------------------------------------------------
+class StreamStats(object):
+    """
+    Health and latency of a video stream: grab rate, retrieve latency,
+    frames skipped between reads, frame age at read and frames skipped by
+    motion gating
+    """
+
+    GAUGES = ["uptime_seconds", "grab_fps", "motion_skip_ratio"]
+    COUNTERS = ["frames_grabbed", "grab_failures", "frames_read",
+                "frames_skipped", "read_timeouts", "frames_gated",
+                "frames_static"]
+    HISTOGRAMS = ["retrieve_latency_seconds", "skipped_frames_per_read",
+                  "frame_age_seconds"]
+
+    def __init__(self, name, ewma_alpha=0.1):
+        self.name = name
+        self.ewma_alpha = ewma_alpha
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time()
+            self.last_grab_time = None
+            self.grab_interval = None
+            for counter in self.COUNTERS:
+                setattr(self, counter, 0)
+            self.retrieve_latency_seconds = Histogram(LATENCY_BUCKETS)
+            self.skipped_frames_per_read = Histogram(COUNT_BUCKETS)
+            self.frame_age_seconds = Histogram(LATENCY_BUCKETS)
+
+    def on_grab(self, status, latency, timestamp):
+        with self.lock:
+            if not status:
+                self.grab_failures += 1
+                return
+            self.frames_grabbed += 1
+            self.retrieve_latency_seconds.observe(latency)
+            if self.last_grab_time is not None:
+                interval = timestamp - self.last_grab_time
+                self.grab_interval = interval if self.grab_interval is None \
+                    else self.grab_interval + \
+                    self.ewma_alpha * (interval - self.grab_interval)
+            self.last_grab_time = timestamp
+
+    def on_read(self, skipped, age):
+        with self.lock:
+            self.frames_read += 1
+            self.frames_skipped += skipped
+            self.skipped_frames_per_read.observe(skipped)
+            self.frame_age_seconds.observe(age)
+
+    def on_gate(self, changed):
+        with self.lock:
+            self.frames_gated += 1
+            self.frames_static += int(not changed)
+
+    def on_timeout(self):
+        with self.lock:
+            self.read_timeouts += 1
+
+    @property
+    def grab_fps(self):
+        return 1. / self.grab_interval if self.grab_interval else 0.
+
+    @property
+    def motion_skip_ratio(self):
+        """Ratio of gated frames without motion"""
+        return self.frames_static / self.frames_gated \
+            if self.frames_gated else 0.
+
+    def snapshot(self):
+        with self.lock:
+            data = {"name": self.name,
+                    "uptime_seconds": time() - self.start_time,
+                    "grab_fps": self.grab_fps,
+                    "motion_skip_ratio": self.motion_skip_ratio}
+            for counter in self.COUNTERS:
+                data[counter] = getattr(self, counter)
+            for histogram in self.HISTOGRAMS:
+                data[histogram] = getattr(self, histogram).snapshot()
+        return data
+
+    def __str__(self):
+        return "[{}] {}".format(self.__class__.__name__, self.snapshot())
+
+
+# ------------------------------------------------------------------------------
+#  Prometheus export
+# ------------------------------------------------------------------------------
+def _escape_label(value):
+    """Escape a label value for the Prometheus text exposition format"""
+    return str(value).replace('\\', '\\\\').replace(
+        '\n', '\\n').replace('"', '\\"')
+
+
+def strip_userinfo(source):
+    """Remove user:password@ from a stream URL, e.g. to use it as a label"""
+    parts = urlsplit(source)
+    if '@' not in parts.netloc:
+        return source
+    netloc = parts.netloc.rsplit('@', 1)[1]
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+def to_prometheus(stats_list, prefix="cvut_stream"):
+    """
+    stats_list (list) of StreamStats, or a single StreamStats
+    Return metrics in the Prometheus text exposition format
+    """
+    if isinstance(stats_list, StreamStats):
+        stats_list = [stats_list]
+    snapshots = [stats.snapshot() for stats in stats_list]
+
+    def _labels(snapshot, **extra):
+        labels = dict(stream=snapshot["name"], **extra)
+        return ",".join('{}="{}"'.format(key, _escape_label(value))
+                        for key, value in labels.items())
+
+    lines = []
+    for gauge in StreamStats.GAUGES:
+        metric = "{}_{}".format(prefix, gauge)
+        lines.append("# TYPE {} gauge".format(metric))
+        for snapshot in snapshots:
+            lines.append("{}{{{}}} {}".format(
+                metric, _labels(snapshot), snapshot[gauge]))
+    for counter in StreamStats.COUNTERS:
+        metric = "{}_{}_total".format(prefix, counter)
+        lines.append("# TYPE {} counter".format(metric))
+        for snapshot in snapshots:
+            lines.append("{}{{{}}} {}".format(
+                metric, _labels(snapshot), snapshot[counter]))
+    for histogram in StreamStats.HISTOGRAMS:
+        metric = "{}_{}".format(prefix, histogram)
+        lines.append("# TYPE {} histogram".format(metric))
+        for snapshot in snapshots:
+            data = snapshot[histogram]
+            for bucket, count in data["buckets"].items():
+                lines.append("{}_bucket{{{}}} {}".format(
+                    metric, _labels(snapshot, le=bucket), count))
+            lines.append("{}_sum{{{}}} {}".format(
+                metric, _labels(snapshot), data["sum"]))
+            lines.append("{}_count{{{}}} {}".format(
+                metric, _labels(snapshot), data["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(stats_list, outfile, prefix="cvut_stream"):
+    """
+    Write metrics to outfile atomically, e.g. for the textfile collector of
+    the Prometheus node exporter
+    """
+    tmpfile = "{}.{}.tmp".format(outfile, os.getpid())
+    with open(tmpfile, 'w') as fp:
+        fp.write(to_prometheus(stats_list, prefix))
+    os.replace(tmpfile, outfile)
+
+
+def serve_prometheus(stats_list, port, host="127.0.0.1",
+                     prefix="cvut_stream"):
+    """
+    Serve metrics over HTTP on a daemon thread, for Prometheus to scrape
+    Return the HTTPServer, call its shutdown() to stop
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = to_prometheus(stats_list, prefix).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), _Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
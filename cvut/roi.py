@@ -4,7 +4,7 @@ from shapely.geometry.polygon import Polygon
 
 from .draw import draw_polygons
 
-__all__ = ['RoIFilter']
+__all__ = ['RoIFilter', 'MultiRoIFilter']
 
 
 # ------------------------------------------------------------------------------
@@ -13,11 +13,26 @@ __all__ = ['RoIFilter']
 class RoIFilter(object):
 
     MODES = ['center', 'bottom_center', 'top_center', 'intersect']
+    BACKENDS = ['numpy', 'shapely', 'raster']
 
     def __init__(self, points, mode,
-                 hroi=None, wroi=None, aroi=None, intersect_thr=0.1):
+                 hroi=None, wroi=None, aroi=None, intersect_thr=0.1,
+                 backend='numpy', raster_scale=1.0):
+        """
+        backend (str) 'numpy' runs a vectorized crossing-number test for the
+            point modes, 'shapely' checks boxes one by one. 'raster' looks up
+            intersection ratios of the 'intersect' mode in a summed-area
+            table of the rasterized RoI, otherwise it behaves like 'numpy'.
+            The 'intersect' mode uses shapely unless backend is 'raster'.
+        raster_scale (float) raster cells per pixel of the 'raster' backend,
+            lower is faster to build and smaller, but less accurate
+        """
         assert mode in self.MODES
+        assert backend in self.BACKENDS
         self.mode = mode
+        self.backend = backend
+        self.raster_scale = raster_scale
+        self._raster = None
         self.hroi = hroi
         self.wroi = wroi
         self.aroi = aroi
@@ -29,7 +44,10 @@ class RoIFilter(object):
     def __call__(self, bboxes):
         """Check whether bboxes in RoI"""
         # check in roi
-        if self.mode != 'intersect':
+        if self.mode != 'intersect' and self.backend != 'shapely':
+            points = self._get_points(bboxes, self.mode)
+            inroi_inds = self._contains_points(points)
+        elif self.mode != 'intersect':
             points = [self._get_point(x1, y1, x2, y2, self.mode)
                       for (x1, y1, x2, y2) in bboxes[:, :4]]
             points = [Point(x, y) for (x, y) in points]
@@ -37,6 +55,9 @@ class RoIFilter(object):
             inroi_inds = []
             for point in points:
                 inroi_inds.append(self.roi.contains(point))
+        elif self.backend == 'raster':
+            intersect_ratios = self._compute_intersect_raster(bboxes)
+            inroi_inds = intersect_ratios >= self.intersect_thr
         else:
             query_polygons = [Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2)])
                               for (x1, y1, x2, y2) in bboxes[:, :4]]
@@ -77,10 +98,191 @@ class RoIFilter(object):
             raise NotImplementedError
         return x, y
 
+    def _get_points(self, bboxes, mode):
+        """Vectorized _get_point, return points shape [N,2]"""
+        bboxes = np.asarray(bboxes, dtype=float)
+        xs = 0.5 * (bboxes[:, 0] + bboxes[:, 2])
+        if mode == 'center':
+            ys = 0.5 * (bboxes[:, 1] + bboxes[:, 3])
+        elif mode == 'bottom_center':
+            ys = bboxes[:, 3]
+        elif mode == 'top_center':
+            ys = bboxes[:, 1]
+        else:
+            raise NotImplementedError
+        return np.stack([xs, ys], axis=1)
+
+    def _contains_points(self, points):
+        """
+        Vectorized crossing-number test of points shape [N,2] against the
+        RoI. Like shapely contains, points on the boundary are outside.
+        """
+        xs, ys = points[:, 0:1], points[:, 1:2]
+        x1, y1 = self.points[None, :, 0], self.points[None, :, 1]
+        x2 = np.roll(self.points[:, 0], -1)[None]
+        y2 = np.roll(self.points[:, 1], -1)[None]
+
+        # count edges crossed by the ray going right from each point
+        crossing = (y1 > ys) != (y2 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        inside = (crossing & (xs < x_cross)).sum(axis=1) % 2 == 1
+
+        # exclude points lying on an edge
+        collinear = (x2 - x1) * (ys - y1) == (y2 - y1) * (xs - x1)
+        within = (np.minimum(x1, x2) <= xs) & (xs <= np.maximum(x1, x2)) & \
+            (np.minimum(y1, y2) <= ys) & (ys <= np.maximum(y1, y2))
+        on_edge = (collinear & within).any(axis=1)
+        return inside & ~on_edge
+
     def _compute_intersect(self, p1, p2):
         ratio = p1.intersection(p2).area / p1.area
         return ratio
 
+    def _get_raster(self):
+        """
+        Rasterize the RoI once, over its bounding box, into a summed-area
+        table of cell coverage. Cell (i, j) covers [j, j+1) x [i, i+1) in
+        raster coordinates, which are pixels scaled by raster_scale.
+        """
+        if self._raster is not None:
+            return self._raster
+        scale = self.raster_scale
+        x0, y0 = np.floor(self.points.min(axis=0))
+        x1, y1 = np.ceil(self.points.max(axis=0))
+        width = int(np.ceil((x1 - x0) * scale)) + 1
+        height = int(np.ceil((y1 - y0) * scale)) + 1
+
+        # even-odd scanline fill sampled at cell centers: for each row,
+        # toggle coverage at the first cell right of each edge crossing
+        points = (self.points - [x0, y0]) * scale
+        px1, py1 = points[None, :, 0], points[None, :, 1]
+        px2 = np.roll(points[:, 0], -1)[None]
+        py2 = np.roll(points[:, 1], -1)[None]
+        ys = np.arange(height)[:, None] + 0.5
+        crossing = (py1 > ys) != (py2 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs = px1 + (ys - py1) * (px2 - px1) / (py2 - py1)
+        rows, edges = np.nonzero(crossing)
+        cols = np.clip(np.floor(xs[rows, edges] - 0.5).astype(int) + 1,
+                       0, width)
+        toggles = np.zeros((height, width + 1), dtype='int32')
+        np.add.at(toggles, (rows, cols), 1)
+        coverage = toggles[:, :-1].cumsum(axis=1) % 2
+
+        sat = np.zeros((height + 1, width + 1), dtype='float64')
+        sat[1:, 1:] = coverage.cumsum(axis=0).cumsum(axis=1)
+        self._raster = (sat, x0, y0)
+        return self._raster
+
+    def _compute_intersect_raster(self, bboxes):
+        """Intersection ratios of bboxes shape [N,4+] from the raster RoI"""
+        sat, x0, y0 = self._get_raster()
+        scale = self.raster_scale
+        bboxes = np.asarray(bboxes, dtype=float)
+        xs1 = (bboxes[:, 0] - x0) * scale
+        ys1 = (bboxes[:, 1] - y0) * scale
+        xs2 = (bboxes[:, 2] - x0) * scale
+        ys2 = (bboxes[:, 3] - y0) * scale
+
+        def _lookup(xs, ys):
+            # bilinear interpolation of the integral, exact for cells of
+            # uniform coverage
+            xs = np.clip(xs, 0, sat.shape[1] - 1)
+            ys = np.clip(ys, 0, sat.shape[0] - 1)
+            ix = np.minimum(xs.astype(int), sat.shape[1] - 2)
+            iy = np.minimum(ys.astype(int), sat.shape[0] - 2)
+            dx, dy = xs - ix, ys - iy
+            return (1 - dy) * ((1 - dx) * sat[iy, ix] + dx * sat[iy, ix+1]) + \
+                dy * ((1 - dx) * sat[iy+1, ix] + dx * sat[iy+1, ix+1])
+
+        areas = _lookup(xs2, ys2) - _lookup(xs1, ys2) - \
+            _lookup(xs2, ys1) + _lookup(xs1, ys1)
+        box_areas = (bboxes[:, 2] - bboxes[:, 0]) * \
+            (bboxes[:, 3] - bboxes[:, 1]) * scale ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = areas / box_areas
+        return ratios
+
+
+# ------------------------------------------------------------------------------
+#   MultiRoIFilter
+# ------------------------------------------------------------------------------
+class MultiRoIFilter(object):
+    """
+    Check bboxes against many zones in one call. Each zone is a RoIFilter,
+    with its own hroi, wroi and aroi, and zone bounding boxes serve as a
+    spatial index, so each zone only checks the boxes that may be inside it.
+    """
+
+    def __init__(self, zones, mode, **kwargs):
+        """
+        zones (list/dict) of zone, a zone is either the RoI points, or a dict
+            of RoIFilter arguments overriding mode and kwargs, e.g.
+            dict(points=points, hroi=(10, 200)). Dict keys are zone ids,
+            otherwise zone ids are indices.
+        kwargs: default arguments of RoIFilter, e.g. hroi, wroi, aroi,
+            intersect_thr, backend, raster_scale
+        """
+        if isinstance(zones, dict):
+            self.zone_names = list(zones.keys())
+            zones = list(zones.values())
+        else:
+            self.zone_names = list(range(len(zones)))
+
+        self.filters = []
+        for zone in zones:
+            zone_kwargs = dict(kwargs, mode=mode)
+            if isinstance(zone, dict):
+                zone_kwargs.update(zone)
+            else:
+                zone_kwargs['points'] = zone
+            self.filters.append(RoIFilter(**zone_kwargs))
+
+        # spatial index, [Z,4] bounding boxes of zones
+        self.zone_bboxes = np.array([
+            np.concatenate([roi_filter.points.min(axis=0),
+                            roi_filter.points.max(axis=0)])
+            for roi_filter in self.filters]).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.filters)
+
+    def __call__(self, bboxes):
+        """Return membership (np.bool) shape [N,Z], bbox n is in zone z"""
+        bboxes = np.asarray(bboxes, dtype=float)
+        membership = np.zeros((len(bboxes), len(self.filters)), dtype=bool)
+        if len(bboxes) == 0:
+            return membership
+
+        points = dict()
+        for idx, roi_filter in enumerate(self.filters):
+            zx1, zy1, zx2, zy2 = self.zone_bboxes[idx]
+            if roi_filter.mode == 'intersect':
+                candidates = (bboxes[:, 0] < zx2) & (bboxes[:, 2] > zx1) & \
+                    (bboxes[:, 1] < zy2) & (bboxes[:, 3] > zy1)
+            else:
+                if roi_filter.mode not in points:
+                    points[roi_filter.mode] = roi_filter._get_points(
+                        bboxes, roi_filter.mode)
+                xs, ys = points[roi_filter.mode].T
+                candidates = (xs > zx1) & (xs < zx2) & (ys > zy1) & (ys < zy2)
+            if candidates.any():
+                membership[candidates, idx] = roi_filter(bboxes[candidates])
+        return membership
+
+    def zone_ids(self, bboxes):
+        """Return list of zone ids of each bbox, len [N,]"""
+        membership = self(bboxes)
+        return [[self.zone_names[idx] for idx in np.flatnonzero(row)]
+                for row in membership]
+
+    def draw_roi(self, image, **kwargs):
+        image = draw_polygons(
+            image, [roi_filter.points for roi_filter in self.filters],
+            **kwargs)
+        return image
+
 
 # ------------------------------------------------------------------------------
 #  Test bench
@@ -96,6 +298,77 @@ if __name__ == '__main__':
         ratio = roi_filter._compute_intersect(Polygon(query), Polygon(roi))
         assert ratio == 1
 
+    def test_point_modes(num_boxes=500):
+        roi = [(100, 100), (900, 150), (1000, 900), (500, 600), (50, 950)]
+        bboxes = np.random.randint(0, 1100, (num_boxes, 4)).astype(float)
+        bboxes[:, 2:] = bboxes[:, :2] + \
+            np.random.randint(0, 200, (num_boxes, 2))
+        # boxes whose centers lie on a vertex and on an edge
+        bboxes[:2] = [[90, 90, 110, 110], [490, 115, 510, 135]]
+
+        runtimes = dict()
+        for mode in ['center', 'bottom_center', 'top_center']:
+            outputs = dict()
+            for backend in RoIFilter.BACKENDS:
+                roi_filter = RoIFilter(roi, mode=mode, backend=backend)
+                tic = time.perf_counter()
+                outputs[backend] = roi_filter(bboxes)
+                runtimes[backend] = runtimes.get(backend, 0) + \
+                    time.perf_counter() - tic
+            assert (outputs['numpy'] == outputs['shapely']).all()
+        return runtimes
+
+    def test_intersect_raster(num_boxes=500, raster_scale=1.0, tol=0.001):
+        roi = [(100, 100), (900, 150), (1000, 900), (500, 600), (50, 950)]
+        bboxes = np.random.uniform(0, 1100, (num_boxes, 4))
+        bboxes[:, 2:] = bboxes[:, :2] + \
+            np.random.uniform(10, 200, (num_boxes, 2))
+
+        roi_filter = RoIFilter(roi, mode='intersect', backend='shapely')
+        tic = time.perf_counter()
+        ratios = np.array([
+            roi_filter._compute_intersect(
+                Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2)]),
+                roi_filter.roi)
+            for (x1, y1, x2, y2) in bboxes])
+        runtimes = {'shapely': time.perf_counter() - tic}
+
+        roi_filter = RoIFilter(roi, mode='intersect', backend='raster',
+                               raster_scale=raster_scale)
+        roi_filter._get_raster()
+        tic = time.perf_counter()
+        raster_ratios = roi_filter._compute_intersect_raster(bboxes)
+        runtimes['raster'] = time.perf_counter() - tic
+        assert np.abs(raster_ratios - ratios).mean() <= tol
+        return runtimes
+
+    def test_multi_zones(num_boxes=500, num_zones=20):
+        bboxes = np.random.uniform(0, 1900, (num_boxes, 4))
+        bboxes[:, 2:] = bboxes[:, :2] + \
+            np.random.uniform(10, 200, (num_boxes, 2))
+        zones = dict()
+        for idx in range(num_zones):
+            x, y = np.random.uniform(0, 1700, 2)
+            points = [(x, y), (x + 200, y + 20),
+                      (x + 150, y + 180), (x, y + 150)]
+            zones["zone{}".format(idx)] = dict(points=points, hroi=(0, 150))
+
+        runtimes = dict()
+        for mode in RoIFilter.MODES:
+            multi_filter = MultiRoIFilter(zones, mode=mode)
+            tic = time.perf_counter()
+            membership = multi_filter(bboxes)
+            runtimes['multi'] = runtimes.get('multi', 0) + \
+                time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            for idx, zone in enumerate(zones.values()):
+                roi_filter = RoIFilter(mode=mode, **zone)
+                assert (membership[:, idx] == roi_filter(bboxes)).all()
+            runtimes['single'] = runtimes.get('single', 0) + \
+                time.perf_counter() - tic
+        return runtimes
+
     num_runs = 100
     tic = time.perf_counter()
     for _ in range(num_runs):
@@ -103,3 +376,32 @@ if __name__ == '__main__':
     toc = time.perf_counter()
     print("test_itersect_ratio: avg. time {} ms".format(
         int(1e3 * (toc - tic) / num_runs)))
+
+    num_runs = 10
+    total_runtimes = {backend: 0 for backend in RoIFilter.BACKENDS}
+    for _ in range(num_runs):
+        for backend, runtime in test_point_modes().items():
+            total_runtimes[backend] += runtime
+    for backend, runtime in total_runtimes.items():
+        print("test_point_modes [{}]: avg. time {:.2f} ms".format(
+            backend, 1e3 * runtime / num_runs))
+
+    total_runtimes = {'multi': 0, 'single': 0}
+    for _ in range(num_runs):
+        for name, runtime in test_multi_zones().items():
+            total_runtimes[name] += runtime
+    for name, runtime in total_runtimes.items():
+        print("test_multi_zones [{}]: avg. time {:.2f} ms".format(
+            name, 1e3 * runtime / num_runs))
+
+    for raster_scale, tol in [(1.0, 0.001), (0.25, 0.005)]:
+        total_runtimes = {'shapely': 0, 'raster': 0}
+        for _ in range(num_runs):
+            runtimes = test_intersect_raster(
+                raster_scale=raster_scale, tol=tol)
+            for backend, runtime in runtimes.items():
+                total_runtimes[backend] += runtime
+        for backend, runtime in total_runtimes.items():
+            print("test_intersect_raster [{}, scale={}]: avg. time "
+                  "{:.2f} ms".format(backend, raster_scale,
+                                     1e3 * runtime / num_runs))
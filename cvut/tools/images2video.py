@@ -1,7 +1,45 @@
 import cv2
-import cvut
 import argparse
+from time import time
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cvut.image import glob_imgs
+from cvut.video import create_video
+
+
+# ------------------------------------------------------------------------------
+#  Utils
+# ------------------------------------------------------------------------------
+def read_image(img_file, size):
+    """Read an image, resized to size (width, height) if it mismatches"""
+    image = cv2.imread(img_file)
+    if image is None:
+        return None, False
+    resized = (image.shape[1], image.shape[0]) != size
+    if resized:
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image, resized
+
+
+def read_images(img_files, size, num_workers=4, queue_size=16):
+    """
+    Decode images on num_workers threads, keeping at most queue_size images
+    ahead of the consumer. Yield (image, resized) in the order of img_files
+    """
+    if num_workers <= 0:
+        for img_file in img_files:
+            yield read_image(img_file, size)
+        return
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        pending = deque()
+        for img_file in img_files:
+            pending.append(executor.submit(read_image, img_file, size))
+            if len(pending) >= queue_size:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
 
 
 # ------------------------------------------------------------------------------
@@ -21,21 +59,44 @@ def main():
     parser.add_argument('--fps', type=int, default=30,
                         help="Video FPS")
 
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Number of threads decoding images ahead of the "
+                             "writer, 0 decodes serially")
+
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help="Maximum number of images decoded ahead")
+
     args = parser.parse_args()
 
     # get images
-    img_files = cvut.glob_imgs(args.imgdir)
+    img_files = glob_imgs(args.imgdir)
     num_imgs = len(img_files)
     print(f"Number of imgs: {num_imgs}")
 
     # create video
     image = cv2.imread(img_files[0])
     size = (image.shape[1], image.shape[0])
-    out = cvut.create_video(args.video, size, args.fps)
+    out = create_video(args.video, size, args.fps)
 
-    for img_file in tqdm(img_files, total=len(img_files)):
-        out.write(cv2.imread(img_file))
+    # frames are resized to the size of the first one, a mismatched frame
+    # would otherwise be dropped by the writer
+    num_written, num_resized, num_failed = 0, 0, 0
+    tic = time()
+    images = read_images(img_files, size, args.workers, args.queue_size)
+    for img_file, (image, resized) in tqdm(
+            zip(img_files, images), total=len(img_files)):
+        if image is None:
+            print(f"Cannot read {img_file}")
+            num_failed += 1
+            continue
+        out.write(image)
+        num_written += 1
+        num_resized += int(resized)
+    out.release()
 
+    runtime = max(time() - tic, 1e-6)
+    print(f"Written {num_written} frames ({num_written / runtime:.1f} fps) "
+          f"in {runtime:.2f}s, resized {num_resized}, failed {num_failed}")
     print(f"Video is saved at {args.video}")
 
 
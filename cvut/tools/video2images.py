@@ -2,7 +2,138 @@ import os
 import cv2
 import argparse
 import numpy as np
+from time import time
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# ------------------------------------------------------------------------------
+#  Utils
+# ------------------------------------------------------------------------------
+def get_selected_frames(num_frames, start=0, stop=-1, step=1, num=-1,
+                        txt_frames=None):
+    """Sorted indices of the frames to extract"""
+    if txt_frames is not None:
+        frames = np.unique(np.loadtxt(txt_frames, dtype=int).reshape(-1))
+        if num_frames > 0:
+            frames = frames[(frames >= 0) & (frames < num_frames)]
+        return frames.tolist()
+    stop = stop if stop != -1 else num_frames
+    frames = range(start, stop, step)
+    return list(frames if num == -1 else frames[:num])
+
+
+def get_write_params(fmt='jpg', quality=95):
+    """cv2.imwrite params of the output format"""
+    if fmt == 'jpg':
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if fmt == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return []
+
+
+def get_outfile(outdir, idx, base=0, fmt='jpg'):
+    out_idx = idx if base == 0 else idx+1
+    return os.path.join(outdir, 'frame_{:08d}.{}'.format(out_idx, fmt))
+
+
+def extract_sparse(cap, outdir, selected_frames, base=0, seek_gap=250,
+                   fmt='jpg', quality=95, num_writers=4, pos=0, verbose=True):
+    """
+    Extract only the selected frames. Frames in between are grabbed without
+    being retrieved, gaps longer than seek_gap frames are seeked over, which
+    lands on the previous keyframe and decodes forward to the target.
+    seek_gap -1 never seeks. Encoding and writing run on num_writers threads.
+    pos (int) index of the next frame cap decodes
+    Return number of frames decoded, skipped and seeks
+    """
+    params = get_write_params(fmt, quality)
+    pos, num_decoded, num_skipped, num_seeks = pos, 0, 0, 0
+    tic = time()
+    # bound the number of frames waiting for the writers
+    pending = deque()
+    with ThreadPoolExecutor(max(num_writers, 1)) as writers:
+        for idx in tqdm(selected_frames, total=len(selected_frames),
+                        disable=not verbose):
+            gap = idx - pos
+            if seek_gap != -1 and gap > seek_gap:
+                if cap.set(cv2.CAP_PROP_POS_FRAMES, idx):
+                    num_seeks += 1
+                    num_skipped += gap
+                    gap, pos = 0, idx
+            status = True
+            for _ in range(gap):
+                status = cap.grab()
+                if not status:
+                    break
+            num_skipped += max(gap, 0)
+            if not status:
+                break
+
+            status, frame = cap.read()
+            if not status:
+                break
+            pos = idx + 1
+            num_decoded += 1
+            outfile = get_outfile(outdir, idx, base, fmt)
+            pending.append(writers.submit(cv2.imwrite, outfile, frame, params))
+            while len(pending) > 4 * max(num_writers, 1):
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+    runtime = max(time() - tic, 1e-6)
+    if verbose:
+        print("Decoded {} frames ({:.1f} fps), skipped {} frames "
+              "({:.1f} fps), {} seeks in {:.2f}s".format(
+                  num_decoded, num_decoded / runtime, num_skipped,
+                  num_skipped / runtime, num_seeks, runtime))
+    return num_decoded, num_skipped, num_seeks
+
+
+def _extract_segment(video, outdir, selected_frames, base, seek_gap, fmt,
+                     quality, num_writers):
+    """Extract a contiguous segment of selected frames in a worker process"""
+    cap = cv2.VideoCapture(video)
+    pos = 0
+    if selected_frames[0] > 0 and \
+            cap.set(cv2.CAP_PROP_POS_FRAMES, selected_frames[0]):
+        pos = selected_frames[0]
+    result = extract_sparse(cap, outdir, selected_frames, base, seek_gap,
+                            fmt, quality, num_writers, pos, verbose=False)
+    cap.release()
+    return result
+
+
+def extract_parallel(video, outdir, selected_frames, num_workers, base=0,
+                     seek_gap=250, fmt='jpg', quality=95, num_writers=4):
+    """
+    Split the selected frames into num_workers contiguous segments, each
+    decoded by its own process starting with a seek to its first frame
+    Return number of frames decoded, skipped and seeks
+    """
+    segments = [segment.tolist() for segment in
+                np.array_split(np.asarray(selected_frames, dtype=int),
+                               num_workers) if len(segment)]
+    if not len(segments):
+        print("No frame to extract")
+        return 0, 0, 0
+    tic = time()
+    with ProcessPoolExecutor(len(segments)) as executor:
+        futures = [executor.submit(
+            _extract_segment, video, outdir, segment, base, seek_gap, fmt,
+            quality, num_writers) for segment in segments]
+        results = [future.result() for future in
+                   tqdm(futures, total=len(futures))]
+    num_decoded, num_skipped, num_seeks = np.sum(results, axis=0).tolist()
+
+    runtime = max(time() - tic, 1e-6)
+    print("Decoded {} frames ({:.1f} fps), skipped {} frames ({:.1f} fps), "
+          "{} seeks in {:.2f}s with {} workers".format(
+              num_decoded, num_decoded / runtime, num_skipped,
+              num_skipped / runtime, num_seeks, runtime, len(segments)))
+    return num_decoded, num_skipped, num_seeks
 
 
 # ------------------------------------------------------------------------------
@@ -37,6 +168,29 @@ def main():
     parser.add_argument('--txt-frames', type=str, default=None,
                         help="Txt file containing frames to extract")
 
+    parser.add_argument('--sparse', action='store_true',
+                        help="Decode only the selected frames, grab or seek "
+                             "over the others")
+
+    parser.add_argument('--seek-gap', type=int, default=250,
+                        help="In sparse mode, seek over gaps longer than this "
+                             "number of frames, -1 never seeks")
+
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes decoding frame ranges in "
+                             "parallel, each seeks to its first frame")
+
+    parser.add_argument('--writers', type=int, default=4,
+                        help="Number of threads encoding and writing images "
+                             "in sparse/parallel modes")
+
+    parser.add_argument('--format', type=str, default='jpg',
+                        choices=['jpg', 'png', 'webp'],
+                        help="Image format")
+
+    parser.add_argument('--quality', type=int, default=95,
+                        help="JPEG/WebP quality")
+
     args = parser.parse_args()
 
     # get video
@@ -49,6 +203,26 @@ def main():
     outdir = os.path.join(args.outdir, ".".join(basename.split('.')[:-1]))
     os.makedirs(outdir, exist_ok=True)
 
+    # sparse/parallel extraction
+    if args.sparse or args.workers > 1:
+        selected_frames = get_selected_frames(
+            num_frames, args.start, args.stop, args.step, args.num,
+            args.txt_frames)
+        print(f"Number of selected frames: {len(selected_frames)}")
+        if args.workers > 1:
+            cap.release()
+            extract_parallel(
+                args.video, outdir, selected_frames, args.workers, args.base,
+                args.seek_gap, args.format, args.quality, args.writers)
+        else:
+            extract_sparse(
+                cap, outdir, selected_frames, args.base, args.seek_gap,
+                args.format, args.quality, args.writers)
+        print("Extracted frames are saved at \'{}\"".format(outdir))
+        return
+
+    params = get_write_params(args.format, args.quality)
+
     # get attribs
     start = args.start
     stop = args.stop if args.stop != -1 else num_frames
@@ -60,6 +234,7 @@ def main():
     if args.txt_frames is not None:
         selected_frames = np.loadtxt(args.txt_frames, dtype=int)
         print(f"Selected frames: {selected_frames}")
+        selected_frames = set(selected_frames.reshape(-1).tolist())
         max_num_frames = num_frames
 
     # extract frames
@@ -67,17 +242,14 @@ def main():
     count_step = 0
     for idx in tqdm(range(num_frames), total=num_frames):
 
-        out_idx = idx if args.base == 0 else idx+1
-
         status, frame = cap.read()
         if not status:
             break
 
         if selected_frames is not None:
             if idx in selected_frames:
-                outfile = os.path.join(outdir,
-                                       'frame_{:08d}.jpg'.format(out_idx))
-                cv2.imwrite(outfile, frame)
+                outfile = get_outfile(outdir, idx, args.base, args.format)
+                cv2.imwrite(outfile, frame, params)
             continue
 
         if idx < start:
@@ -89,8 +261,8 @@ def main():
             count_step += 1
             continue
 
-        outfile = os.path.join(outdir, 'frame_{:08d}.jpg'.format(out_idx))
-        cv2.imwrite(outfile, frame)
+        outfile = get_outfile(outdir, idx, args.base, args.format)
+        cv2.imwrite(outfile, frame, params)
 
         count_step += 1
         num_get_frames += 1
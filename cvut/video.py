@@ -1,11 +1,23 @@
 import os
 import cv2
+import warnings
+import numpy as np
+import multiprocessing as mp
+import multiprocessing.connection
 from time import time, sleep
-from threading import Thread, Lock
+from queue import Queue, Empty, Full
+from collections import deque
+from threading import Thread, Condition, Event
+from .metrics import StreamStats, strip_userinfo
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = resource_tracker = None  # Python < 3.8
 
 
 __all__ = ["setup_cv2_window", "get_video", "create_video",
-           "StreamVideoCapture"]
+           "AsyncVideoWriter", "StreamVideoCapture", "MultiStreamCapture",
+           "VideoFrameIterator", "MotionGate"]
 
 
 # ------------------------------------------------------------------------------
@@ -31,26 +43,249 @@ def get_video(video_file):
     return cap, (width, height), num_frames, fps
 
 
-def create_video(out_file, out_size, fps=30, codec='MP4V'):
+def _read_into(cap, out):
+    """
+    cap.read() into the preallocated out. OpenCV allocates a new frame when
+    the decoded one does not fit out, e.g. after a resolution change, then
+    it is copied into out, resized if needed
+    """
+    status, frame = cap.read(out)
+    if not status or frame is out or np.may_share_memory(frame, out):
+        return status
+    if frame.dtype != out.dtype or frame.shape[2:] != out.shape[2:]:
+        return False
+    if frame.shape != out.shape:
+        frame = cv2.resize(frame, (out.shape[1], out.shape[0]))
+    out[...] = frame
+    return True
+
+
+def create_video(out_file, out_size, fps=30, codec='MP4V', async_write=False,
+                 **kwargs):
+    """
+    async_write (bool) return an AsyncVideoWriter encoding on a background
+        thread, kwargs are passed to it
+    """
     dirname = os.path.dirname(out_file)
-    os.makedirs(dirname, exist_ok=True)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
     fourcc = cv2.VideoWriter_fourcc(*codec)
     out = cv2.VideoWriter(out_file, fourcc, fps, out_size)
+    if async_write:
+        out = AsyncVideoWriter(out, **kwargs)
     return out
 
 
+class AsyncVideoWriter(object):
+    """
+    Wrap a cv2.VideoWriter so that write() only queues the frame, encoding
+    runs on a background thread. When the queue is full, policy decides:
+        'block': wait for the encoder (backpressure)
+        'drop_new': drop the incoming frame
+        'drop_old': drop the oldest queued frame
+    release() flushes the queue before releasing the writer.
+    """
+    POLICIES = ['block', 'drop_new', 'drop_old']
+
+    def __init__(self, writer, queue_size=32, policy='block', copy=True):
+        """
+        writer (cv2.VideoWriter)
+        queue_size (int) maximum number of queued frames
+        copy (bool) queue a copy of the frame, so the caller can reuse its
+            buffer right after write()
+        """
+        assert policy in self.POLICIES, \
+            "Invalid policy {}, only support {}".format(policy, self.POLICIES)
+        self.writer = writer
+        self.queue_size = queue_size
+        self.policy = policy
+        self.copy = copy
+        self.queue = deque()
+        self.cond = Condition()
+        self.stopped = False
+        self.num_queued = 0
+        self.num_dropped = 0
+        self.num_written = 0
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self, frame):
+        """Return False if the frame was dropped"""
+        if self.copy:
+            frame = frame.copy()
+        with self.cond:
+            assert not self.stopped, "Write to a released AsyncVideoWriter"
+            if len(self.queue) >= self.queue_size:
+                if self.policy == 'block':
+                    self.cond.wait_for(
+                        lambda: len(self.queue) < self.queue_size)
+                elif self.policy == 'drop_new':
+                    self.num_dropped += 1
+                    return False
+                else:
+                    self.queue.popleft()
+                    self.num_dropped += 1
+            self.queue.append(frame)
+            self.num_queued += 1
+            self.cond.notify_all()
+        return True
+
+    def release(self):
+        """Flush queued frames, then release the writer"""
+        with self.cond:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.writer.release()
+
+    @property
+    def stats(self):
+        with self.cond:
+            return {"queued": self.num_queued, "dropped": self.num_dropped,
+                    "written": self.num_written, "pending": len(self.queue)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.queue) or self.stopped)
+                if not len(self.queue):
+                    break
+                frame = self.queue.popleft()
+                self.cond.notify_all()
+            self.writer.write(frame)
+            with self.cond:
+                self.num_written += 1
+
+
+class MotionGate(object):
+    """
+    Cheap motion detector for live streams. A frame is downsampled to a
+    small gray image and compared with the last changed frame, its score is
+    the ratio of pixels whose difference exceeds pixel_threshold. A frame is
+    changed when score >= threshold, or when no frame was changed for
+    keyframe_interval seconds.
+    """
+
+    def __init__(self, threshold=0.01, pixel_threshold=25, size=(64, 36),
+                 keyframe_interval=5.0, drop=True):
+        """
+        threshold (float) minimum ratio of changed pixels, in [0,1]
+        pixel_threshold (int) minimum gray-level difference of a pixel
+        size (tuple) (width, height) of the downsampled gray image
+        keyframe_interval (float) seconds after which a frame is changed
+            regardless of motion, -1 is not used
+        drop (bool) StreamVideoCapture does not deliver unchanged frames,
+            otherwise they are delivered and marked unchanged
+        """
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.size = tuple(size)
+        self.keyframe_interval = keyframe_interval
+        self.drop = drop
+        self.reference = None
+        self.last_key_time = None
+
+    def __call__(self, frame, timestamp):
+        """
+        frame (np.uint8) shape [H,W,3], BGR image
+        timestamp (float) seconds
+        Return (changed, score)
+        """
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if self.reference is None:
+            score = 1.
+        else:
+            diff = cv2.absdiff(small, self.reference)
+            score = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+        changed = score >= self.threshold or (
+            self.keyframe_interval != -1 and
+            timestamp - self.last_key_time >= self.keyframe_interval)
+        if changed:
+            self.reference = small
+            self.last_key_time = timestamp
+        return changed, score
+
+
 class StreamVideoCapture(object):
-    """Realtime RTSP stream, dealing with latency"""
-    lock = Lock()
-    last_ready = False
+    """
+    Realtime RTSP stream, dealing with latency. A background thread decodes
+    frames into a small ring buffer, readers wait on a condition instead of
+    spinning. Every stream has its own lock, so many cameras can be served
+    from a single process.
+    """
+    PACINGS = ['fixed', 'adaptive']
 
     def __init__(self,
                  cap_or_link_or_path,
-                 max_wait=100,
+                 max_wait=None,
                  sleep_time=0,
-                 num_runs_get_fps=-1):
+                 num_runs_get_fps=-1,
+                 timeout=1.0,
+                 buffer_size=2,
+                 name=None,
+                 motion_gate=None,
+                 pacing='fixed',
+                 ewma_alpha=0.1):
+        """
+        max_wait: deprecated, number of spins of the former busy-wait, use
+            timeout instead
+        sleep_time (float) seconds to sleep after each grab
+        num_runs_get_fps (int) number of grabs to measure the stream FPS,
+            which then sets sleep_time. -1 is not used.
+        timeout (float) seconds read() waits for a new frame. With a
+            motion_gate dropping frames, a static scene extends the wait up
+            to keyframe_interval + timeout, or only timeout when keyframes
+            are disabled
+        buffer_size (int) number of decoded frames kept in the ring buffer
+        name (str) stream label in self.stats, defaults to the link, without
+            user:password@, or path
+        motion_gate (MotionGate) scores motion on the capture thread, then
+            frame_changed and motion_score describe the frame last read
+        pacing (str) 'fixed' sleeps sleep_time after each grab. 'adaptive'
+            tracks the inter-frame interval of the source and the read
+            interval of the consumer with an EWMA of factor ewma_alpha:
+            video files are paced at their FPS, live streams are grabbed as
+            they come, and when the consumer is slower than the source only
+            the newest frame is kept and frames it would never read are
+            grabbed without being retrieved
+        """
+        assert pacing in self.PACINGS, \
+            "Invalid pacing {}, only support {}".format(pacing, self.PACINGS)
+        if max_wait is not None:
+            warnings.warn(
+                "max_wait is deprecated and ignored, use timeout (seconds)",
+                DeprecationWarning, stacklevel=2)
         self.max_wait = max_wait
+        self.timeout = timeout
         self.sleep_time = sleep_time
+        self.buffer = deque(maxlen=buffer_size)
+        self.cond = Condition()
+        self.stopped = False
+        self.seq = 0
+        self.last_read_seq = 0
+        self.motion_gate = motion_gate
+        self.frame_changed = True
+        self.motion_score = 1.
+        self.last_gated_time = None
+        self.pacing = pacing
+        self.ewma_alpha = ewma_alpha
+        self.frame_interval = None
+        self.read_interval = None
+        self.last_read_time = None
 
         # video capture
         if isinstance(cap_or_link_or_path, str):
@@ -58,41 +293,183 @@ class StreamVideoCapture(object):
         else:
             self.cap = cap_or_link_or_path
 
+        # health and latency, see cvut.metrics
+        if name is None:
+            # credentials of the link must not end up in metric labels
+            name = strip_userinfo(cap_or_link_or_path) \
+                if isinstance(cap_or_link_or_path, str) \
+                else "stream{}".format(id(self))
+        self.stats = StreamStats(name)
+
         # measure fps
         if num_runs_get_fps != -1:
             fps = self._get_fps(num_runs_get_fps)
             print("Stream FPS:", fps)
             self.sleep_time = 1 / fps
 
+        # adaptive pacing: video files have a nominal interval to pace at,
+        # reading live streams blocks until the next frame arrives
+        self.nominal_interval = None
+        if self.cap.get(cv2.CAP_PROP_FRAME_COUNT) > 0:
+            fps = self.cap.get(cv2.CAP_PROP_FPS)
+            self.nominal_interval = 1. / fps if fps > 0 else None
+
         # run thread
-        thread = Thread(target=self._run)
-        thread.daemon = True
-        thread.start()
-        sleep(1)
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def read(self):
-        wait = 0
-        while True:
-            if self.last_ready:
-                status, frame = self.cap.retrieve()
-                if status:
-                    return status, frame
-                else:
-                    wait += 1
-                    if wait >= self.max_wait:
-                        print("Exceed max_wait={}".format(self.max_wait))
-                        return False, None
+    def read(self, latest=True):
+        """
+        Wait up to timeout seconds for a frame not read yet. With a
+        motion_gate dropping frames, waiting continues while frames keep
+        being grabbed, until the next changed frame or keyframe, for at most
+        keyframe_interval + timeout seconds. Only a dead stream times out,
+        a static scene returns (False, None) with frame_changed False,
+        without counting a timeout
+        latest (bool) return the newest frame and drop older ones, otherwise
+            return the oldest buffered frame
+        """
+        with self.cond:
+            now = time()
+            if self.last_read_time is not None:
+                self.read_interval = self._ewma(
+                    self.read_interval, now - self.last_read_time)
+            self.last_read_time = now
+            deadline = now + self.timeout
+            if self.motion_gate is not None and \
+                    self.motion_gate.keyframe_interval != -1:
+                deadline += self.motion_gate.keyframe_interval
+            while True:
+                ready = self.cond.wait_for(
+                    lambda: len(self.buffer) or self.stopped,
+                    timeout=min(self.timeout, max(deadline - time(), 0)))
+                # a static scene, not a timeout, if the gate dropped frames
+                static = self.last_gated_time is not None and \
+                    time() - self.last_gated_time <= self.timeout
+                if ready or not static or time() >= deadline:
+                    break
+            if not ready and static:
+                self.frame_changed = False
+                return False, None
+            if not ready or not len(self.buffer):
+                self.stats.on_timeout()
+                print("Exceed timeout={}s".format(self.timeout))
+                return False, None
+            if latest:
+                frame, timestamp, seq, changed, score = self.buffer.pop()
+                self.buffer.clear()
             else:
-                wait += 1
-                if wait >= self.max_wait:
-                    print("Exceed max_wait={}".format(self.max_wait))
-                    return False, None
+                frame, timestamp, seq, changed, score = self.buffer.popleft()
+            self.frame_changed, self.motion_score = changed, score
+            # frames decoded but never delivered, incl. ring buffer overflow
+            skipped = seq - self.last_read_seq - 1
+            self.last_read_seq = seq
+        self.stats.on_read(skipped, time() - timestamp)
+        return True, frame
+
+    def release(self):
+        """
+        Stop the capture thread, which releases the capture on exit, never
+        while it is blocked inside cap.read()
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join(timeout=self.timeout)
+        if self.thread.is_alive():
+            print("Capture is released once the pending read returns")
+
+    @property
+    def source_interval(self):
+        """Inter-frame interval of the source, at most its nominal FPS"""
+        if self.frame_interval is None or self.nominal_interval is None:
+            return self.frame_interval
+        return max(self.frame_interval, self.nominal_interval)
+
+    @property
+    def source_fps(self):
+        return 1. / self.source_interval if self.source_interval else 0.
+
+    @property
+    def consumer_fps(self):
+        return 1. / self.read_interval if self.read_interval else 0.
+
+    def _ewma(self, value, sample):
+        if value is None:
+            return sample
+        return value + self.ewma_alpha * (sample - value)
+
+    def _consumer_slower(self):
+        return self.pacing == 'adaptive' and \
+            self.frame_interval is not None and \
+            self.read_interval is not None and \
+            self.read_interval > self.source_interval
 
     def _run(self):
-        while True:
-            with self.lock:
-                self.last_ready = self.cap.grab()
-            sleep(self.sleep_time)
+        try:
+            self._grab_loop()
+        finally:
+            self.cap.release()
+
+    def _grab_loop(self):
+        last_timestamp, slept = None, 0
+        while not self.stopped:
+            tic = time()
+            # the consumer reads again after the next frame arrives, so this
+            # one would be replaced before being read
+            retrieve = not self._consumer_slower() or \
+                tic + self.source_interval >= \
+                self.last_read_time + self.read_interval
+            if retrieve:
+                status, frame = self.cap.read()
+            else:
+                status, frame = self.cap.grab(), None
+            timestamp = time()
+            self.stats.on_grab(status, timestamp - tic, timestamp)
+            if not status:
+                # avoid spinning while the stream is unavailable
+                sleep(max(self.sleep_time, 0.01))
+                last_timestamp, slept = None, 0
+                continue
+
+            # real inter-frame interval, without the time slept on purpose
+            if last_timestamp is not None:
+                self.frame_interval = self._ewma(
+                    self.frame_interval, timestamp - last_timestamp - slept)
+            last_timestamp = timestamp
+
+            if frame is None:
+                with self.cond:
+                    self.seq += 1
+            else:
+                changed, score = True, 1.
+                if self.motion_gate is not None:
+                    changed, score = self.motion_gate(frame, timestamp)
+                    self.stats.on_gate(changed)
+                if changed or not self.motion_gate.drop:
+                    with self.cond:
+                        if self._consumer_slower():
+                            # keep latency low, only the newest is read
+                            self.buffer.clear()
+                        self.seq += 1
+                        self.buffer.append(
+                            (frame, timestamp, self.seq, changed, score))
+                        self.cond.notify_all()
+                else:
+                    with self.cond:
+                        self.last_gated_time = timestamp
+
+            slept = self._get_sleep_time(tic)
+            sleep(slept)
+
+    def _get_sleep_time(self, tic):
+        if self.pacing == 'fixed':
+            return self.sleep_time
+        if self.nominal_interval is None:
+            return 0
+        # start grabs of a video file every nominal interval
+        return max(self.nominal_interval - (time() - tic), 0)
 
     def _get_fps(self, num_runs=100):
         print("Measuring stream...")
@@ -102,3 +479,361 @@ class StreamVideoCapture(object):
         runtime = time() - tic
         fps = num_runs / runtime
         return fps
+
+
+# ------------------------------------------------------------------------------
+#  MultiStreamCapture
+# ------------------------------------------------------------------------------
+# header of a shared-memory slot: [sequence number of the latest frame, slot]
+_HEADER_SIZE = 2
+
+
+def _decode_worker(source, conn, cond, stop_event, num_slots, sleep_time):
+    """Decode source in a worker process into shared-memory frame slots"""
+    cap = cv2.VideoCapture(source)
+    status, frame = cap.read()
+    while not status and not stop_event.is_set():
+        sleep(max(sleep_time, 0.01))
+        status, frame = cap.read()
+    if not status:
+        conn.send(None)
+        cap.release()
+        return
+
+    # the parent owns the shared memory, the worker only attaches to it,
+    # whenever the parent reads the frame shape, possibly long after
+    conn.send((frame.shape, frame.dtype.str))
+    while not conn.poll(0.1):
+        if stop_event.is_set():
+            cap.release()
+            return
+    shm_name = conn.recv()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    header = np.ndarray((_HEADER_SIZE,), dtype='int64', buffer=shm.buf)
+    frames = np.ndarray((num_slots,) + frame.shape, dtype=frame.dtype,
+                        buffer=shm.buf, offset=header.nbytes)
+
+    seq = 0
+    frames[0] = frame
+    while not stop_event.is_set():
+        if status:
+            with cond:
+                header[:] = (seq, seq % num_slots)
+                cond.notify_all()
+            seq += 1
+            sleep(sleep_time)
+        else:
+            sleep(max(sleep_time, 0.01))
+        # decode straight into the next slot, no copy
+        status = _read_into(cap, frames[seq % num_slots])
+
+    del header, frames
+    shm.close()
+    cap.release()
+
+
+class MultiStreamCapture(object):
+    """
+    Decode many streams in worker processes, each worker publishes its
+    latest frame into a shared-memory ring of num_slots frames. Consumers get
+    NumPy views of the frames with no copy and no pickling.
+        streams = MultiStreamCapture([link1, link2, ...])
+        status, frame = streams.read(0)  # or streams[0].read()
+        seq = streams.seqs[0]            # sequence number of that frame
+    A returned view stays valid until num_slots-1 newer frames of the same
+    stream are decoded, copy it to keep it longer.
+    """
+
+    def __init__(self, sources, num_slots=3, sleep_time=0, timeout=5.0):
+        """
+        sources (list) of RTSP link/video path
+        num_slots (int) number of frame slots per stream
+        sleep_time (float) seconds to sleep after each grab in workers
+        timeout (float) seconds to wait for the first frame of all streams,
+            and for a new frame in read(). A stream whose first frame comes
+            later is attached by read()
+        """
+        assert shared_memory is not None, \
+            "MultiStreamCapture requires Python >= 3.8"
+        self.sources = sources
+        self.num_slots = num_slots
+        self.timeout = timeout
+        self.seqs = [-1] * len(sources)
+
+        # workers must share the resource tracker of this process, otherwise
+        # their own trackers unlink the shared memory when they exit
+        resource_tracker.ensure_running()
+
+        self.stop_event = mp.Event()
+        self.conds, self.conns, self.procs = [], [], []
+        for source in sources:
+            parent_conn, child_conn = mp.Pipe()
+            cond = mp.Condition()
+            proc = mp.Process(
+                target=_decode_worker,
+                args=(source, child_conn, cond, self.stop_event, num_slots,
+                      sleep_time))
+            proc.daemon = True
+            proc.start()
+            self.conds.append(cond)
+            self.conns.append(parent_conn)
+            self.procs.append(proc)
+
+        # allocate shared memory once the frame shape of a stream is known,
+        # waiting for all streams against a single deadline
+        self.shms = [None] * len(sources)
+        self.headers = [None] * len(sources)
+        self.frames = [None] * len(sources)
+        deadline = time() + timeout
+        pending = list(range(len(sources)))
+        while len(pending) and time() < deadline:
+            ready = mp.connection.wait(
+                [self.conns[idx] for idx in pending],
+                timeout=max(deadline - time(), 0))
+            for idx in [idx for idx in pending if self.conns[idx] in ready]:
+                self._attach(idx)
+                pending.remove(idx)
+        for idx in pending:
+            print("Cannot read stream {} yet".format(sources[idx]))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, idx):
+        return _StreamReader(self, idx)
+
+    def read(self, idx, timeout=None):
+        """
+        Wait for a frame of stream idx newer than the last one read
+        Return (status, frame), frame is a view of shared memory
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if self.headers[idx] is None and not self.stop_event.is_set() and \
+                self.conns[idx].poll(timeout):
+            # first frame of a stream that was late at construction
+            self._attach(idx)
+        header = self.headers[idx]
+        if header is None:
+            return False, None
+        last_seq = self.seqs[idx]
+        with self.conds[idx]:
+            ready = self.conds[idx].wait_for(
+                lambda: header[0] > last_seq, timeout=timeout)
+            seq, slot = header.tolist()
+        if not ready:
+            print("Exceed timeout={}s".format(timeout))
+            return False, None
+        self.seqs[idx] = seq
+        return True, self.frames[idx][slot]
+
+    def _attach(self, idx):
+        """Allocate the shared memory of stream idx from its frame shape"""
+        meta = self.conns[idx].recv()
+        if meta is None:
+            return
+        shape, dtype = meta
+        dtype = np.dtype(dtype)
+        header_nbytes = _HEADER_SIZE * np.dtype('int64').itemsize
+        shm = shared_memory.SharedMemory(
+            create=True,
+            size=header_nbytes + self.num_slots * int(np.prod(shape)) *
+            dtype.itemsize)
+        header = np.ndarray((_HEADER_SIZE,), dtype='int64', buffer=shm.buf)
+        header[:] = (-1, 0)
+        frames = np.ndarray((self.num_slots,) + tuple(shape), dtype=dtype,
+                            buffer=shm.buf, offset=header_nbytes)
+        self.conns[idx].send(shm.name)
+        self.shms[idx] = shm
+        self.headers[idx] = header
+        self.frames[idx] = frames
+
+    def release(self):
+        self.stop_event.set()
+        for proc in self.procs:
+            proc.join(timeout=self.timeout)
+            if proc.is_alive():
+                proc.terminate()
+        self.headers = [None] * len(self.sources)
+        self.frames = [None] * len(self.sources)
+        for shm in self.shms:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.shms = [None] * len(self.sources)
+
+
+class _StreamReader(object):
+    """One stream of MultiStreamCapture, with the StreamVideoCapture API"""
+
+    def __init__(self, manager, idx):
+        self.manager = manager
+        self.idx = idx
+
+    @property
+    def seq(self):
+        return self.manager.seqs[self.idx]
+
+    def read(self):
+        return self.manager.read(self.idx)
+
+
+# ------------------------------------------------------------------------------
+#  VideoFrameIterator
+# ------------------------------------------------------------------------------
+class VideoFrameIterator(object):
+    """
+    Decode a video ahead on a background thread into a bounded queue, and
+    yield (indices, frames) batches ready for batch inference:
+        indices (np.int64) shape [B], frame indices in the video
+        frames (np.uint8) shape [B,H,W,3], contiguous
+    The last batch may be smaller than batch_size.
+    """
+
+    def __init__(self,
+                 video_file,
+                 batch_size=1,
+                 stride=1,
+                 start=0,
+                 stop=None,
+                 size=None,
+                 color_code=None,
+                 interpolation=cv2.INTER_LINEAR,
+                 queue_size=4):
+        """
+        stride (int) decode every stride-th frame, others are only grabbed
+        start, stop (int) frame range [start, stop), stop None is the end
+        size (tuple) (width, height) to resize frames to in the worker
+        color_code (int) cv2.cvtColor code applied in the worker,
+            e.g. cv2.COLOR_BGR2RGB
+        queue_size (int) number of batches decoded ahead
+        """
+        assert batch_size >= 1 and stride >= 1 and start >= 0
+        self.video_file = video_file
+        self.batch_size = batch_size
+        self.stride = stride
+        self.start = start
+        self.size = size
+        self.color_code = color_code
+        self.interpolation = interpolation
+
+        self.cap, (width, height), num_frames, self.fps = \
+            get_video(video_file)
+        # CAP_PROP_FRAME_COUNT is 0 or negative when unknown, e.g. streams
+        if num_frames > 0:
+            stop = num_frames if stop is None else min(stop, num_frames)
+        self.stop = stop
+        self.frame_size = (width, height) if size is None else tuple(size)
+
+        self.queue = Queue(maxsize=queue_size)
+        self.stop_event = Event()
+        self.thread = None
+
+    def __len__(self):
+        """Number of batches, when the frame count is known"""
+        assert self.stop is not None, "Unknown number of frames"
+        num_frames = len(range(self.start, self.stop, self.stride))
+        return (num_frames + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        assert self.thread is None, "VideoFrameIterator can be iterated once"
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            # unblock the worker if it waits on a full queue
+            while self.thread.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    self.thread.join(timeout=0.01)
+        self.cap.release()
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            self._decode()
+        except Exception as e:
+            self._put(e)
+        self._put(None)
+
+    def _decode(self):
+        if self.start > 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+        # without preprocessing, frames are decoded straight into the batch
+        direct = self.size is None and self.color_code is None
+        idx, count = self.start, 0
+        indices = frames = None
+        while not self.stop_event.is_set():
+            if self.stop is not None and idx >= self.stop:
+                break
+            if (idx - self.start) % self.stride:
+                if not self.cap.grab():
+                    break
+                idx += 1
+                continue
+
+            if direct:
+                if frames is None:
+                    width, height = self.frame_size
+                    frames = np.empty(
+                        [self.batch_size, height, width, 3], dtype=np.uint8)
+                status = _read_into(self.cap, frames[count])
+            else:
+                status, frame = self.cap.read()
+                if status:
+                    frame = self._preprocess(frame)
+                    if frames is None:
+                        frames = np.empty(
+                            (self.batch_size,) + frame.shape, frame.dtype)
+                    frames[count] = frame
+            if not status:
+                break
+
+            if indices is None:
+                indices = np.empty([self.batch_size], dtype=np.int64)
+            indices[count] = idx
+            count += 1
+            idx += 1
+            if count == self.batch_size:
+                if not self._put((indices, frames)):
+                    return
+                indices = frames = None
+                count = 0
+
+        if count:
+            self._put((indices[:count], frames[:count]))
+
+    def _preprocess(self, frame):
+        if self.size is not None:
+            frame = cv2.resize(
+                frame, self.frame_size, interpolation=self.interpolation)
+        if self.color_code is not None:
+            frame = cv2.cvtColor(frame, self.color_code)
+        return frame